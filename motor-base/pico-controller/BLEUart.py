@@ -32,6 +32,11 @@ class BleUart:
     async def send(self, data):
         self._write.write(data, send_update=True)
 
+    def notify(self, data):
+        """Send without awaiting, for use from the receive callback."""
+        if self.connected:
+            self._write.write(data, send_update=True)
+
     async def watch_for_data(self):
         while self.connected:
             try:
@@ -56,5 +61,6 @@ class BleUart:
                 self.connected = True
                 task = asyncio.create_task(self.watch_for_data())
                 await connection.disconnected(timeout_ms=None)
+                self.connected = False
                 task.cancel()
                 led.off()
@@ -0,0 +1,136 @@
+from time import ticks_ms, ticks_diff
+import ujson
+import uasyncio as asyncio
+from motor_controller import TUNING_FILE
+
+PID_PERIOD_MS = 50  # as pid_update_loop
+SAMPLE_MS = 10
+SETTLE_MS = 500
+STEP_DUTY = 50
+STEP_MS = 1500
+TEST_SPEEDS = [20, 60]
+TEST_MS = 3000
+SETTLE_BAND = 0.05  # settled once within 5% of the setpoint
+
+async def sample_speed(motor, ms):
+    """Average speed over ms."""
+    total = 0
+    count = 0
+    start = ticks_ms()
+    while ticks_diff(ticks_ms(), start) < ms:
+        total += motor.get_speed()
+        count += 1
+        await asyncio.sleep_ms(SAMPLE_MS)
+    return total / count
+
+async def measure_feedforward(motor):
+    """Open loop steady state speed at each 10% of duty, as (duty, speed) pairs with speed increasing."""
+    table = []
+    for duty in range(0, 101, 10):
+        motor.set_speed(duty)
+        await asyncio.sleep_ms(SETTLE_MS)
+        speed = await sample_speed(motor, 200)
+        # Keep the table monotonic so it can be inverted
+        if table and speed < table[-1][1]:
+            speed = table[-1][1]
+        table.append((duty, speed))
+    motor.set_speed(0)
+    await asyncio.sleep_ms(SETTLE_MS)
+    return table
+
+async def step_response(motor, duty=STEP_DUTY):
+    """
+        First order plus dead time model from an open loop step from rest.
+        Returns gain (speed per duty), dead time and time constant in seconds.
+    """
+    samples = []
+    start = ticks_ms()
+    motor.set_speed(duty)
+    while ticks_diff(ticks_ms(), start) < STEP_MS:
+        samples.append((ticks_diff(ticks_ms(), start), motor.get_speed()))
+        await asyncio.sleep_ms(SAMPLE_MS)
+    motor.set_speed(0)
+    await asyncio.sleep_ms(SETTLE_MS)
+
+    tail = [speed for _, speed in samples[-len(samples) // 5:]]
+    final = sum(tail) / len(tail)
+    if final <= 0:
+        raise ValueError("motor didn't move")
+    dead_time = next((t for t, speed in samples if speed > 0.05 * final), 0)
+    t63 = next((t for t, speed in samples if speed >= 0.63 * final), STEP_MS)
+    tau = max(SAMPLE_MS, t63 - dead_time)
+    return final / duty, dead_time / 1000, tau / 1000
+
+def pi_gains(gain, dead_time, tau):
+    """
+        SIMC PI rules (Skogestad), with the closed loop time constant set to the dead time
+        but no faster than the PID period, converted to gains per PID update.
+    """
+    dt = PID_PERIOD_MS / 1000
+    tau_c = max(dead_time, dt)
+    kc = tau / (gain * (tau_c + dead_time))
+    ti = min(tau, 4 * (tau_c + dead_time))
+    return kc, kc * dt / ti, 0.0
+
+async def closed_loop_test(motor_pid, setpoint):
+    """Overshoot (% of setpoint) and settling time (ms) for a step to setpoint."""
+    motor_pid.integral = 0
+    motor_pid.last_setting = 0
+    motor_pid.last_value = 0
+    motor_pid.set_speed(setpoint)
+    start = ticks_ms()
+    peak = 0
+    settled_at = 0
+    while ticks_diff(ticks_ms(), start) < TEST_MS:
+        motor_pid.update()
+        await asyncio.sleep_ms(PID_PERIOD_MS)
+        speed = motor_pid.motor.get_speed()
+        peak = max(peak, speed)
+        if abs(speed - setpoint) > SETTLE_BAND * setpoint:
+            settled_at = ticks_diff(ticks_ms(), start)
+    motor_pid.set_speed(0)
+    motor_pid.update()
+    await asyncio.sleep_ms(SETTLE_MS)
+    overshoot = max(0, (peak - setpoint) * 100 / setpoint)
+    # Never settled within the test
+    if settled_at >= TEST_MS - PID_PERIOD_MS:
+        settled_at = None
+    return overshoot, settled_at
+
+async def evaluate(motor_pid):
+    results = []
+    for setpoint in TEST_SPEEDS:
+        overshoot, settling = await closed_loop_test(motor_pid, setpoint)
+        results.append({"setpoint": setpoint, "overshoot": round(overshoot, 1), "settling_ms": settling})
+    return results
+
+async def autotune(motor_control, filename=TUNING_FILE):
+    """
+        Identify each motor, compute PI gains and a feedforward table and save them to flash.
+        Wheels must be off the ground. Prints closed loop overshoot and settling time
+        with the gains in use before and after tuning.
+    """
+    tuning = {"motors": [], "report": []}
+    for i, motor_pid in enumerate(motor_control.get_motors()):
+        motor = motor_pid.motor
+        print("Motor", i)
+        before = await evaluate(motor_pid)
+        print("  before", before)
+
+        feedforward = await measure_feedforward(motor)
+        gain, dead_time, tau = await step_response(motor)
+        kp, ki, kd = pi_gains(gain, dead_time, tau)
+        print("  gain {:.3f} dead time {:.3f}s tau {:.3f}s -> kp {:.3f} ki {:.3f} kd {:.3f}".format(
+            gain, dead_time, tau, kp, ki, kd))
+        motor_pid.tune(kp, ki, kd, feedforward)
+
+        after = await evaluate(motor_pid)
+        print("  after", after)
+        tuning["motors"].append({"kp": kp, "ki": ki, "kd": kd, "feedforward": feedforward})
+        tuning["report"].append({"before": before, "after": after,
+                                 "model": {"gain": gain, "dead_time": dead_time, "tau": tau}})
+
+    with open(filename, "w") as f:
+        ujson.dump(tuning, f)
+    print("Saved tuning to", filename)
+    return tuning
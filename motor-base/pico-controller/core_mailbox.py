@@ -0,0 +1,35 @@
+import _thread
+
+class Mailbox:
+    """
+        Fixed size, lock protected queue for passing messages between the two cores.
+        Never allocates after creation apart from the messages themselves.
+        When full, put drops the new message and returns False.
+    """
+    def __init__(self, size: int):
+        self.slots = [None] * size
+        self.size = size
+        self.head = 0  # next to get
+        self.count = 0
+        self.dropped = 0
+        self.lock = _thread.allocate_lock()
+
+    def put(self, message) -> bool:
+        with self.lock:
+            if self.count == self.size:
+                self.dropped += 1
+                return False
+            self.slots[(self.head + self.count) % self.size] = message
+            self.count += 1
+            return True
+
+    def get(self):
+        """Oldest message, or None if empty."""
+        with self.lock:
+            if self.count == 0:
+                return None
+            message = self.slots[self.head]
+            self.slots[self.head] = None
+            self.head = (self.head + 1) % self.size
+            self.count -= 1
+            return message
@@ -0,0 +1,151 @@
+import _thread
+from core_mailbox import Mailbox
+try:
+    from time import ticks_us, ticks_diff, ticks_add, sleep_us
+except ImportError:
+    # Host simulation under CPython, see dual_core_bench.py
+    from time import perf_counter_ns, sleep
+    def ticks_us():
+        return perf_counter_ns() // 1000
+    def ticks_diff(a, b):
+        return a - b
+    def ticks_add(a, b):
+        return a + b
+    def sleep_us(us):
+        sleep(us / 1000000)
+
+CONTROL_PERIOD_US = 10000  # as CONTROL_PERIOD_MS in motor_controller
+PID_EVERY = 5
+TELEMETRY_EVERY = 20  # control periods between odometry deltas, i.e. 200ms
+
+class ControlCore:
+    """
+        Runs motor control on the second core with _thread, so BLE and command handling on the
+        first core can't delay it. The MotorControl is created on the second core, so the encoder
+        interrupts are handled there too.
+        The first core talks to it through a mailbox of commands, use proxy() in place of a
+        MotorControl on the first core. Stops don't go through the mailbox: the first core just
+        bumps stop_seq, which the control core checks every period, so a stop can neither block
+        (it is safe from the fail-safe timer callback) nor be dropped when the mailbox is full.
+        Each command is posted with the stop_seq at the time, so a stop is applied after the
+        commands posted before it and before those posted after it.
+        Odometry deltas are summed on the control core until the first core takes them.
+        Lateness of each control period is recorded so jitter can be checked.
+    """
+    def __init__(self, motor_control_factory, period_us: int = CONTROL_PERIOD_US):
+        self.motor_control_factory = motor_control_factory
+        self.period_us = period_us
+        self.commands = Mailbox(8)
+        self.stop_seq = 0
+        self.delta = None
+        self.delta_lock = _thread.allocate_lock()
+        self.running = False
+        self.ticks = 0
+        self.max_late_us = 0
+        self.total_late_us = 0
+
+    def start(self):
+        self.running = True
+        _thread.start_new_thread(self.run, ())
+
+    def stop(self):
+        self.running = False
+
+    def proxy(self):
+        return MotorControlProxy(self)
+
+    def request_stop(self):
+        """Stop all motors at the next control period, lock free so callable from any context on the first core."""
+        self.stop_seq += 1
+
+    def post_delta(self, delta):
+        with self.delta_lock:
+            if self.delta is None:
+                self.delta = delta
+            else:
+                self.delta = tuple(a + b for a, b in zip(self.delta, delta))
+
+    def take_delta(self):
+        """Odometry delta summed since the last call, None if the rover hasn't moved."""
+        with self.delta_lock:
+            delta = self.delta
+            self.delta = None
+            return delta
+
+    def process_commands(self, motor_control, stop_seq: int) -> int:
+        """Apply queued commands and any stops in between, returns the stop_seq applied up to."""
+        while True:
+            command = self.commands.get()
+            if command is None:
+                break
+            posted_stop_seq, name, args = command
+            if posted_stop_seq != stop_seq:
+                stop_seq = posted_stop_seq
+                motor_control.set_all_speeds(0)
+            if name == "reset_odometry":
+                motor_control.odometry.reset()
+                self.take_delta()
+            else:
+                getattr(motor_control, name)(*args)
+        # Stops requested after the last queued command
+        if self.stop_seq != stop_seq:
+            stop_seq = self.stop_seq
+            motor_control.set_all_speeds(0)
+        return stop_seq
+
+    def run(self):
+        motor_control = self.motor_control_factory()
+        # Stops requested before this core started still apply
+        stop_seq = 0
+        deadline = ticks_us()
+        while self.running:
+            stop_seq = self.process_commands(motor_control, stop_seq)
+            motor_control.odometry.update()
+            if self.ticks % PID_EVERY == 0:
+                motor_control.pid_update()
+            if self.ticks % TELEMETRY_EVERY == 0:
+                delta = motor_control.odometry.take_delta()
+                if delta:
+                    self.post_delta(delta)
+            self.ticks += 1
+            deadline = ticks_add(deadline, self.period_us)
+            wait = ticks_diff(deadline, ticks_us())
+            if wait > 0:
+                sleep_us(wait)
+            late = ticks_diff(ticks_us(), deadline)
+            if late > 0:
+                self.total_late_us += late
+                if late > self.max_late_us:
+                    self.max_late_us = late
+
+class MotorControlProxy:
+    """
+        Stands in for MotorControl on the first core, posting calls to the control core.
+        Calls return False if the mailbox was full and the call was dropped.
+    """
+    def __init__(self, core: ControlCore):
+        self.core = core
+
+    def _post(self, name, *args) -> bool:
+        if self.core.commands.put((self.core.stop_seq, name, args)):
+            return True
+        print("Control mailbox full, dropped", name)
+        return False
+
+    def set_speed(self, speeds) -> bool:
+        return self._post("set_speed", speeds)
+
+    def set_all_speeds(self, speed: int) -> bool:
+        if speed == 0:
+            self.core.request_stop()
+            return True
+        return self._post("set_all_speeds", speed)
+
+    def set_motion(self, speed: int, dir: str) -> bool:
+        if speed == 0 or dir == "s":
+            self.core.request_stop()
+            return True
+        return self._post("set_motion", speed, dir)
+
+    def reset_odometry(self) -> bool:
+        return self._post("reset_odometry")
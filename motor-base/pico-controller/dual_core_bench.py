@@ -0,0 +1,96 @@
+# Host simulation (CPython) stress test of control loop jitter under radio traffic,
+# single uasyncio style loop versus the dual core split. Run with: python3 dual_core_bench.py
+# Radio bursts are modelled as blocking the communications side, as a BLE event burst
+# occupies the core it runs on. CPython threads stand in for the second core; the burst
+# blocks with sleep, which releases the GIL, so the two sides run in parallel like the two cores.
+import asyncio
+import random
+import sys
+import time
+from dual_core import ControlCore, CONTROL_PERIOD_US, PID_EVERY
+
+SECONDS = 5
+BURST_EVERY_MS = (5, 30)
+BURST_LENGTH_MS = (1, 15)
+COMMANDS_PER_BURST = 5
+
+class SimOdometry:
+    def update(self):
+        pass
+
+    def take_delta(self):
+        return None
+
+    def reset(self):
+        pass
+
+class SimMotorControl:
+    """Does about as much arithmetic as the real PID update, without any hardware."""
+    def __init__(self):
+        self.odometry = SimOdometry()
+        self.speeds = [0, 0, 0, 0]
+
+    def pid_update(self):
+        total = 0.0
+        for speed in self.speeds:
+            for _ in range(50):
+                total += speed * 0.1 + 0.05
+        return total
+
+    def set_motion(self, speed, dir):
+        self.speeds = [speed] * 4
+
+    def set_all_speeds(self, speed):
+        self.speeds = [speed] * 4
+
+def busy(ms):
+    # Blocks this side without holding the GIL, see above
+    time.sleep(ms / 1000)
+
+async def radio_traffic(motor_control, until):
+    """Bursts of BLE events, each handled synchronously, as the BLE stack does."""
+    while time.perf_counter() < until:
+        await asyncio.sleep(random.uniform(*BURST_EVERY_MS) / 1000)
+        busy(random.uniform(*BURST_LENGTH_MS))
+        for _ in range(COMMANDS_PER_BURST):
+            motor_control.set_motion(random.randint(0, 100), "f")
+
+async def single_loop():
+    motor_control = SimMotorControl()
+    lateness = []
+    until = time.perf_counter() + SECONDS
+
+    async def control_loop():
+        period = CONTROL_PERIOD_US / 1e6
+        deadline = time.perf_counter()
+        tick = 0
+        while time.perf_counter() < until:
+            motor_control.odometry.update()
+            if tick % PID_EVERY == 0:
+                motor_control.pid_update()
+            tick += 1
+            deadline += period
+            await asyncio.sleep(max(0.0, deadline - time.perf_counter()))
+            lateness.append(max(0.0, time.perf_counter() - deadline) * 1e6)
+
+    await asyncio.gather(control_loop(), radio_traffic(motor_control, until))
+    return len(lateness), max(lateness), sum(lateness) / len(lateness)
+
+async def dual_core():
+    core = ControlCore(SimMotorControl)
+    core.start()
+    await radio_traffic(core.proxy(), time.perf_counter() + SECONDS)
+    core.stop()
+    await asyncio.sleep(0.05)
+    return core.ticks, core.max_late_us, core.total_late_us / max(1, core.ticks)
+
+def main():
+    sys.setswitchinterval(0.0005)
+    random.seed(0)
+    print(f"{'mode':<12}{'ticks':>8}{'max late us':>14}{'mean late us':>14}")
+    for name, run in (("single loop", single_loop), ("dual core", dual_core)):
+        ticks, max_late, mean_late = asyncio.run(run())
+        print(f"{name:<12}{ticks:>8}{max_late:>14.0f}{mean_late:>14.0f}")
+
+if __name__ == "__main__":
+    main()
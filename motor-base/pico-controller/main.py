@@ -3,47 +3,149 @@ import uasyncio as asyncio
 from battery_monitor import BatteryLed, BatteryMonitor
 import BLEUart
 import ure
+from time import ticks_ms
 
 from resettable_timer import ResettableTimer
+from motion_script import MotionScript
+from dual_core import ControlCore
 
-motor_control = MotorControl()
+# Run motor control on the second core, so BLE traffic can't delay it
+DUAL_CORE = False
+
+if DUAL_CORE:
+    control_core = ControlCore(MotorControl)
+    motor_control = control_core.proxy()
+else:
+    motor_control = MotorControl()
+
+# Set by fail_safe, which runs in the timer callback so can't touch uasyncio tasks itself
+fail_safe_flag = asyncio.ThreadSafeFlag()
 
 def fail_safe():
     print("Fail safe stop")
     motor_control.set_all_speeds(0)
+    fail_safe_flag.set()
+
+async def fail_safe_loop():
+    """Abort any running script once the fail safe has stopped the motors."""
+    while True:
+        await fail_safe_flag.wait()
+        script.abort()
 
 def emergency():
     print("Battery dead!!")
     fail_safe()
 
 fail_safe_timer = ResettableTimer(3000, fail_safe)
+script = MotionScript(motor_control, fail_safe_timer.start)
 
 led = BatteryLed()
 monitor = BatteryMonitor(led, emergency)
 
 command_pattern = ure.compile(r"^(\d*)([A-Za-z]+)")
 
+# Sequence numbers of recent commands, so resent commands are acknowledged but not reapplied.
+# The host stops resending a command once this many newer ones have been sent, see DUPLICATE_WINDOW.
+recent_seqs = []
+RECENT_SEQS = 128
+ODOMETRY_REPORT_MS = 200
+
+def script_command(cmd):
+    """
+        Script commands start with "!":
+            - !c          - clear the script
+            - !a<steps>   - append steps "duration_ms:[speed]motion;..."
+            - !g          - start from the first step
+            - !p !r       - pause/resume
+            - !x          - abort
+            - !o          - reset the odometry, handled in apply_command as it isn't a script command
+    """
+    op = cmd[1:2]
+    try:
+        if op == "c":
+            script.clear()
+        elif op == "a":
+            script.append(cmd[2:])
+        elif op == "g":
+            script.start()
+        elif op == "p":
+            script.pause()
+        elif op == "r":
+            script.resume()
+        elif op == "x":
+            script.abort()
+    except ValueError as e:
+        print("Script error ", e)
+
 def command(cmdin):
+    """
+        Commands may be prefixed with a sequence number "#<seq>:", they are then
+        acknowledged with "A<seq>:<ticks_ms when applied>" on the TX characteristic.
+        Commands the control core couldn't take are not acknowledged, so the host resends them.
+    """
     cmd = cmdin.decode()
     print("Received command ", cmd)
+    if cmd.startswith("#"):
+        seq, _, cmd = cmd[1:].partition(":")
+        if seq not in recent_seqs:
+            if not apply_command(cmd):
+                return
+            recent_seqs.append(seq)
+            if len(recent_seqs) > RECENT_SEQS:
+                recent_seqs.pop(0)
+        uart.notify("A{}:{}".format(seq, ticks_ms()))
+    else:
+        apply_command(cmd)
+
+def apply_command(cmd):
+    """Returns False if the command was dropped, only possible with DUAL_CORE when the control mailbox is full."""
+    if cmd == "!o":
+        return motor_control.reset_odometry() is not False
+    if cmd.startswith("!"):
+        script_command(cmd)
+        return True
     match = command_pattern.match(cmd)
     if match:
         speed = match.group(1)
         command = match.group(2)
 
         speed_setting = int(speed) if speed else 50
-        motor_control.set_motion(speed_setting, command)
+        # Manual commands take over from any running script
+        script.abort()
+        if motor_control.set_motion(speed_setting, command) is False:
+            return False
         fail_safe_timer.start()
+    return True
+
+uart = BLEUart.BleUart("rover", command)
+
+def take_odometry_delta():
+    if DUAL_CORE:
+        return control_core.take_delta()
+    return motor_control.odometry.take_delta()
+
+async def odometry_report_loop():
+    """Send pose changes "O<dx mm>,<dy mm>,<dheading mrad>" to the host, only while moving."""
+    while True:
+        await asyncio.sleep_ms(ODOMETRY_REPORT_MS)
+        if uart.connected:
+            delta = take_odometry_delta()
+            if delta:
+                uart.notify("O{},{},{}".format(*delta))
 
 async def main():
-    uart = BLEUart.BleUart("rover", command)
     print("Starting BLE UART service")
 
     tasks = [
-        asyncio.create_task(motor_control.pid_update_loop()),
         asyncio.create_task(monitor.run_monitor()),
+        asyncio.create_task(odometry_report_loop()),
+        asyncio.create_task(fail_safe_loop()),
         asyncio.create_task(uart.run())
     ]
+    if DUAL_CORE:
+        control_core.start()
+    else:
+        tasks.append(asyncio.create_task(motor_control.pid_update_loop()))
     # Wait for everything to finish
     await asyncio.gather(*tasks)
 
@@ -0,0 +1,10 @@
+# Run with the wheels off the ground, saves pid_tuning.json which main.py then loads
+from motor_controller import MotorControl
+import uasyncio as asyncio
+from autotune import autotune
+
+async def main():
+    motor_control = MotorControl()
+    await autotune(motor_control)
+
+asyncio.run(main())
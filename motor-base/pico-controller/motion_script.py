@@ -0,0 +1,113 @@
+from time import ticks_ms, ticks_add, ticks_diff
+import uasyncio as asyncio
+
+MAX_STEPS = 64
+KEEPALIVE_MS = 1000  # how often the keepalive is called during a long step
+
+class MotionScript:
+    """
+        Runs a sequence of timed motion steps on the device, so choreography doesn't depend on BLE latency.
+        Steps are uploaded as text "duration_ms:[speed]motion" separated by ";", e.g. "2000:50f;1500:sr;"
+        in one or more append calls, then started. Each step's end is timed from the end of the previous
+        step (not from when the loop got round to it) so timing errors don't accumulate.
+
+        keepalive is called at each step and at least every KEEPALIVE_MS, to hold off the fail safe
+        timer while a script is legitimately running without host commands.
+    """
+    def __init__(self, motor_control, keepalive=None):
+        self.motor_control = motor_control
+        self.keepalive = keepalive
+        self.steps = []
+        self.step = 0
+        self.task = None
+        self.paused = False
+        self.paused_at = 0
+        self.resumed = asyncio.Event()
+        self.wake = asyncio.Event()
+
+    @property
+    def running(self):
+        return self.task is not None
+
+    def clear(self):
+        self.abort()
+        self.steps = []
+
+    def append(self, text: str):
+        """Parse and append steps, raises ValueError if malformed or the script is too long."""
+        for step in text.split(";"):
+            if not step:
+                continue
+            duration, motion = step.split(":")
+            speed = ""
+            while motion and motion[0].isdigit():
+                speed += motion[0]
+                motion = motion[1:]
+            if not motion or len(self.steps) >= MAX_STEPS:
+                raise ValueError("bad script step " + step)
+            self.steps.append((int(duration), int(speed) if speed else 50, motion))
+
+    def start(self):
+        self.abort()
+        if self.steps:
+            self.task = asyncio.create_task(self._execute())
+
+    def pause(self):
+        if self.running and not self.paused:
+            self.paused = True
+            self.paused_at = ticks_ms()
+            self.resumed.clear()
+            self.motor_control.set_all_speeds(0)
+            self.wake.set()
+
+    def resume(self):
+        if self.paused:
+            self.paused = False
+            self.resumed.set()
+
+    def abort(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+            self.paused = False
+            self.motor_control.set_all_speeds(0)
+
+    def _keepalive(self):
+        if self.keepalive:
+            self.keepalive()
+
+    async def _execute(self):
+        try:
+            deadline = ticks_ms()
+            for i, (duration, speed, motion) in enumerate(self.steps):
+                self.step = i
+                self.motor_control.set_motion(speed, motion)
+                deadline = ticks_add(deadline, duration)
+                while True:
+                    self._keepalive()
+                    if self.paused:
+                        # Time left in this step when paused is carried over on resume
+                        remaining = ticks_diff(deadline, self.paused_at)
+                        # Keep feeding the keepalive so the fail-safe doesn't abort a long pause
+                        while self.paused:
+                            self._keepalive()
+                            try:
+                                await asyncio.wait_for_ms(self.resumed.wait(), KEEPALIVE_MS)
+                            except asyncio.TimeoutError:
+                                pass
+                        deadline = ticks_add(ticks_ms(), remaining)
+                        self.motor_control.set_motion(speed, motion)
+                        continue
+                    left = ticks_diff(deadline, ticks_ms())
+                    if left <= 0:
+                        break
+                    try:
+                        # Woken early by pause
+                        self.wake.clear()
+                        await asyncio.wait_for_ms(self.wake.wait(), min(left, KEEPALIVE_MS))
+                    except asyncio.TimeoutError:
+                        pass
+            self.motor_control.set_all_speeds(0)
+        finally:
+            if self.task is asyncio.current_task():
+                self.task = None
@@ -1,12 +1,18 @@
 from machine import Pin, PWM
-from time import sleep, ticks_us, ticks_diff
+from time import sleep, ticks_us, ticks_ms, ticks_diff, ticks_add
 import micropython
+import ujson
 import uasyncio as asyncio
+from odometry import MecanumOdometry
 
 # Needed if we have hard IRQs for debugging
 micropython.alloc_emergency_exception_buf(100)
 MAX_DUTY = 65535
 MAX_SPEED = 160
+TUNING_FILE = "pid_tuning.json"
+CONTROL_PERIOD_MS = 10  # odometry update rate
+PID_EVERY = 5  # control periods per PID update, i.e. 50ms
+STALL_US = 200000  # no pulse for this long and the motor is taken as stopped
 
 class Motor(object):
     def __init__(self, pwm_pin, dir_pin, pulse_pin, average_over=1):
@@ -19,6 +25,9 @@ class Motor(object):
         self.pulse_total=0
         self.pulse_average=0
         self.pulse_last=0
+        # Total pulses ever seen and last direction driven, for odometry
+        self.pulse_edges=0
+        self.direction=1
         pulse_pin.irq(self.pulse, Pin.IRQ_RISING | Pin.IRQ_FALLING, hard=True)
 
     def pulse(self, arg):
@@ -28,6 +37,7 @@ class Motor(object):
         else:
             self.pulse_total += ticks_diff(ticks_us(), self.pulse_last)
             self.pulse_count += 1
+            self.pulse_edges += 1
             if self.pulse_count >= self.average_over:
                 self.pulse_average = self.pulse_total // self.average_over
                 self.pulse_count = 0
@@ -41,13 +51,18 @@ class Motor(object):
             speed = 100
         elif speed < -100:
             speed = -100
+        # Keep the last pulse measurement unless stopping or reversing, otherwise at low speed
+        # the next PID update often sees no completed pulses and reads zero
+        if speed == 0 or (speed > 0) != (self.speed > 0):
+            self.pulse_average = 0
         self.speed = speed
+        if speed != 0:
+            self.direction = 1 if speed > 0 else -1
         self.pwm.duty_u16(((100 - abs(speed)) * MAX_DUTY)//100)
         self.dir_pin.value(1 if speed > 0 else 0)
-        self.pulse_average = 0
 
     def get_speed(self):
-        if self.pulse_average == 0:
+        if self.pulse_average == 0 or ticks_diff(ticks_us(), self.pulse_last) > STALL_US:
             return 0
         # 45:1 gear, 6 pulses per motor rev, not sure I understand the factor of 2  
         speed = 60*1000000/(45*6*2*self.pulse_average)
@@ -64,12 +79,29 @@ def limit_speed(speed: float) -> int:
         return 0
     return int(speed)
 
+def limit_correction(value: float) -> float:
+    """
+    Limit a feedforward correction term to the range -100 to 100.
+    """
+    if value > 100:
+        return 100
+    elif value < -100:
+        return -100
+    return value
+
 class MotorPID:
-    def __init__(self, motor: Motor, kp:float = 1.0, ki:float = 0.1, kd:float = 0.05):
+    """
+        PID speed control of one motor.
+        Without a feedforward table this is the incremental form, each update adjusting the last output.
+        With a feedforward table, a list of (duty, speed) pairs measured by autotune, the output is the
+        duty expected to give the setpoint speed plus a PID correction for the remaining error.
+    """
+    def __init__(self, motor: Motor, kp:float = 1.0, ki:float = 0.1, kd:float = 0.05, feedforward=None):
         self.motor = motor
         self.kp = kp
         self.ki = ki
         self.kd = kd
+        self.feedforward = feedforward
         self.setpoint = 0
         self.reverse = False
         self.last_setting = 0
@@ -80,12 +112,42 @@ class MotorPID:
         self.setpoint = abs(speed)
         self.reverse = speed < 0
         
+    def tune(self, kp: float, ki: float, kd: float, feedforward):
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.feedforward = feedforward
+        self.integral = 0
+
+    def feedforward_duty(self, speed: float) -> float:
+        """Duty expected to give speed, interpolated from the feedforward table."""
+        table = self.feedforward
+        if speed <= table[0][1]:
+            return table[0][0]
+        for (duty0, speed0), (duty1, speed1) in zip(table, table[1:]):
+            if speed <= speed1:
+                if speed1 == speed0:
+                    return duty1
+                return duty0 + (duty1 - duty0) * (speed - speed0) / (speed1 - speed0)
+        return table[-1][0]
+
     def update(self):
         if self.setpoint == 0:
             self.motor.set_speed(0)
+            if self.feedforward:
+                self.integral = 0
             return
         current_value = self.motor.get_speed()
         error = self.setpoint - current_value
+        if self.feedforward:
+            self.integral = limit_correction(self.integral + error)
+            derivative = -(current_value - self.last_value)
+            correction = (self.kp * error) + (self.ki * self.integral) + (self.kd * derivative)
+            output = limit_speed(self.feedforward_duty(self.setpoint) + correction)
+            self.last_setting = output
+            self.last_value = current_value
+            self.motor.set_speed(-output if self.reverse else output)
+            return
         self.integral = limit_speed(self.integral + error)
         # Use derivative kick trick: http://brettbeauregard.com/blog/2011/04/improving-the-beginners-pid-derivative-kick/
         derivative = -(current_value - self.last_value)
@@ -128,12 +190,28 @@ class MotorControl:
         Class to control multiple motors with PID.
         Motors are initialized  on GPIO pin groups 10+11+12, 13+14+15, 16+17+18 and 19+20+21.
         Each group has 3 pins: PWM, Direction and Pulse.
+        PID gains and feedforward tables are loaded from TUNING_FILE if present, see autotune.py.
 
-        The update loop runs every 50ms to update the motor speeds and needs to be run in an asyncio event loop.
+        The update loop runs every 10ms to update the odometry, and every 50ms to update the motor speeds.
+        It needs to be run in an asyncio event loop.
     """
   
     def __init__(self):
         self.motors = [init_motor(i) for i in range(10, 22, 3)]
+        self.odometry = MecanumOdometry(self.motors)
+        self.load_tuning()
+
+    def load_tuning(self, filename: str = TUNING_FILE):
+        """Apply the gains and feedforward tables saved by autotune, if it has been run."""
+        try:
+            with open(filename) as f:
+                tuning = ujson.load(f)
+        except (OSError, ValueError):
+            return False
+        for motor_pid, params in zip(self.motors, tuning["motors"]):
+            motor_pid.tune(params["kp"], params["ki"], params["kd"], params["feedforward"])
+        print("Loaded PID tuning from", filename)
+        return True
 
     def get_motors(self):
         return self.motors
@@ -159,11 +237,21 @@ class MotorControl:
         """
         self.set_speed([speed]*4)
         
+    def reset_odometry(self):
+        self.odometry.reset()
+
     def set_motion(self, speed: int, dir: str):
         pattern = MOTOR_DECODE.get(dir) or [0,0,0,0]
         self.set_speed([x*speed for x in pattern])
 
     async def pid_update_loop(self):
+        tick = 0
+        # Sleep to a deadline, so the time the updates take doesn't stretch the period
+        deadline = ticks_ms()
         while True:
-            self.pid_update()
-            await asyncio.sleep(0.05)
+            self.odometry.update()
+            if tick % PID_EVERY == 0:
+                self.pid_update()
+            tick += 1
+            deadline = ticks_add(deadline, CONTROL_PERIOD_MS)
+            await asyncio.sleep_ms(max(0, ticks_diff(deadline, ticks_ms())))
@@ -0,0 +1,79 @@
+from math import sin, cos, pi
+
+# Geometry, measure for the actual base
+WHEEL_DIAMETER_MM = 80
+HALF_WHEELBASE_MM = 75  # centre to front/back axle
+HALF_TRACK_MM = 95  # centre to left/right wheel
+# 45:1 gear, 6 pulses per motor rev
+PULSES_PER_WHEEL_REV = 45 * 6
+MM_PER_PULSE = pi * WHEEL_DIAMETER_MM / PULSES_PER_WHEEL_REV
+
+class MecanumOdometry:
+    """
+        Dead reckoning from the wheel encoders using mecanum forward kinematics.
+        Motors are front left, rear left, front right, rear right (as in MOTOR_DECODE) and
+        the encoders only give pulses, so the direction of each wheel is taken from the
+        direction it is being driven, undoing the left hand side inversion in MotorControl.set_speed.
+        Pose is x forward, y left in mm and heading anticlockwise in radians, from the last reset.
+
+        Pulses are counted rather than speeds integrated, so the result doesn't depend on the
+        update loop timing.
+    """
+    def __init__(self, motor_pids):
+        self.motors = [motor_pid.motor for motor_pid in motor_pids]
+        self.last_edges = [motor.pulse_edges for motor in self.motors]
+        self.reset()
+
+    def reset(self):
+        self.x = 0.0
+        self.y = 0.0
+        self.heading = 0.0
+        # Change in pose not yet reported to the host
+        self.delta_x = 0.0
+        self.delta_y = 0.0
+        self.delta_heading = 0.0
+
+    def wheel_distances(self):
+        """Distance each wheel has moved forward since the last call, in mm."""
+        distances = []
+        for i, motor in enumerate(self.motors):
+            edges = motor.pulse_edges
+            pulses = edges - self.last_edges[i]
+            self.last_edges[i] = edges
+            distance = pulses * MM_PER_PULSE * motor.direction
+            # Left hand side motors are mounted reversed
+            distances.append(-distance if i < 2 else distance)
+        return distances
+
+    def update(self):
+        fl, rl, fr, rr = self.wheel_distances()
+        forward = (fl + rl + fr + rr) / 4
+        left = (-fl + rl + fr - rr) / 4
+        turn = (-fl - rl + fr + rr) / (4 * (HALF_WHEELBASE_MM + HALF_TRACK_MM))
+        if forward == 0 and left == 0 and turn == 0:
+            return
+        # Move along the mid-point heading
+        heading = self.heading + turn / 2
+        dx = forward * cos(heading) - left * sin(heading)
+        dy = forward * sin(heading) + left * cos(heading)
+        self.x += dx
+        self.y += dy
+        self.heading += turn
+        self.delta_x += dx
+        self.delta_y += dy
+        self.delta_heading += turn
+
+    def take_delta(self):
+        """
+            Change in pose since the last call as whole mm and milliradians, or None if it hasn't moved.
+            Any remainder is carried over to the next delta so nothing is lost to rounding.
+        """
+        dx = round(self.delta_x)
+        dy = round(self.delta_y)
+        dh = round(self.delta_heading * 1000)
+        if dx == 0 and dy == 0 and dh == 0:
+            return None
+        self.delta_x -= dx
+        self.delta_y -= dy
+        self.delta_heading -= dh / 1000
+        return dx, dy, dh
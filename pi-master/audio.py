@@ -0,0 +1,268 @@
+# Multi-channel audio capture, streaming and direction of arrival estimation
+import struct
+import threading
+import time
+import wave
+from itertools import combinations
+from typing import Iterator, Optional
+import numpy as np
+
+SAMPLE_RATE = 16000
+CHANNELS = 4
+RING_SECONDS = 4
+BLOCK_SIZE = 1024  # frames per direction estimate, 64ms at 16kHz
+HOP_SIZE = 512  # frames between estimates
+SPEED_OF_SOUND = 343.0  # m/s
+# Mic positions in metres, x forward and y left of the array centre, e.g. a 4 mic square
+# array 64mm across, mic 0 front left going anticlockwise. Measure for the actual array.
+MIC_POSITIONS = [(0.032, 0.032), (-0.032, 0.032), (-0.032, -0.032), (0.032, -0.032)]
+
+class RingBuffer:
+    """
+        Lock-free single producer ring buffer of multi-channel frames.
+        The producer copies data in and only then advances written, the total frames ever
+        written. Readers address frames by that absolute position and get skipped forward if
+        they fall more than the capacity behind.
+    """
+    def __init__(self, capacity: int, channels: int, dtype=np.int16):
+        self.capacity = capacity
+        self.channels = channels
+        self.buffer = np.zeros((capacity, channels), dtype)
+        self.written = 0
+
+    def write(self, data):
+        n = len(data)
+        if n > self.capacity:
+            self.written += n - self.capacity
+            data = data[-self.capacity:]
+            n = self.capacity
+        start = self.written % self.capacity
+        first = min(n, self.capacity - start)
+        self.buffer[start:start + first] = data[:first]
+        self.buffer[:n - first] = data[first:]
+        self.written += n
+
+    def read(self, start: int, n: int):
+        """
+            Up to n frames from absolute position start, returns (frames, position after them).
+            Frames already overwritten are skipped.
+        """
+        written = self.written
+        # Leave a margin for a write in progress overwriting the oldest frames
+        start = max(start, written - self.capacity + self.capacity // 8)
+        n = max(0, min(n, written - start))
+        frames = self.buffer[np.arange(start, start + n) % self.capacity]
+        return frames, start + n
+
+    def latest(self, n: int):
+        return self.read(self.written - n, n)[0]
+
+class MicSource:
+    """Live capture from a sound card via sounddevice, writing into the ring buffer from its callback."""
+    def __init__(self, ring: RingBuffer, sample_rate: int = SAMPLE_RATE, device=None):
+        import sounddevice
+        self.ring = ring
+        self.stream = sounddevice.InputStream(samplerate=sample_rate, channels=ring.channels, dtype='int16',
+                                              blocksize=HOP_SIZE // 2, device=device, callback=self.callback)
+
+    def callback(self, indata, frames, time_info, status):
+        self.ring.write(indata)
+
+    def start(self):
+        self.stream.start()
+
+    def stop(self):
+        self.stream.stop()
+
+class WavSource:
+    """
+        Plays a multi-channel 16 bit WAV file into the ring buffer, in place of a microphone.
+        In realtime mode chunks are paced at the sample rate, looping at the end of the file.
+    """
+    def __init__(self, ring: RingBuffer, path: str, realtime: bool = True, loop: bool = True):
+        self.ring = ring
+        self.realtime = realtime
+        self.loop = loop
+        self.sample_rate, self.frames = read_wav(path)
+        if self.frames.shape[1] != ring.channels:
+            raise ValueError(f"{path} has {self.frames.shape[1]} channels, expected {ring.channels}")
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.play, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def play(self):
+        chunk = HOP_SIZE // 2
+        start = time.monotonic()
+        position = 0
+        while self.running:
+            if position >= len(self.frames):
+                if not self.loop:
+                    break
+                position = 0
+            self.ring.write(self.frames[position:position + chunk])
+            position += chunk
+            if self.realtime:
+                played = (self.ring.written / self.sample_rate)
+                time.sleep(max(0.0, start + played - time.monotonic()))
+        self.running = False
+
+def read_wav(path: str):
+    """Sample rate and (frames, channels) int16 array of a 16 bit WAV file."""
+    with wave.open(path, "rb") as f:
+        if f.getsampwidth() != 2:
+            raise ValueError(f"{path} is not 16 bit")
+        data = np.frombuffer(f.readframes(f.getnframes()), dtype='<i2')
+        return f.getframerate(), data.reshape(-1, f.getnchannels())
+
+class Vad:
+    """
+        Simple voice activity detection: block energy well above the tracked noise floor,
+        with most of it in the speech band.
+    """
+    def __init__(self, sample_rate: int = SAMPLE_RATE, energy_ratio: float = 4.0, band_ratio: float = 0.6):
+        self.sample_rate = sample_rate
+        self.energy_ratio = energy_ratio
+        self.band_ratio = band_ratio
+        self.noise_floor = None
+
+    def is_speech(self, block) -> bool:
+        mono = block.mean(axis=1)
+        energy = float(np.mean(mono ** 2)) + 1e-9
+        if self.noise_floor is None:
+            self.noise_floor = energy
+        # Floor follows quiet blocks quickly and loud ones slowly
+        rate = 0.2 if energy < self.noise_floor else 0.005
+        self.noise_floor += rate * (energy - self.noise_floor)
+        if energy < self.energy_ratio * self.noise_floor:
+            return False
+        spectrum = np.abs(np.fft.rfft(mono)) ** 2
+        freqs = np.fft.rfftfreq(len(mono), 1 / self.sample_rate)
+        band = spectrum[(freqs >= 300) & (freqs <= 3400)].sum()
+        return band / (spectrum.sum() + 1e-9) >= self.band_ratio
+
+class DoaEstimator:
+    """
+        Direction of arrival from GCC-PHAT time differences between every pair of mics,
+        all pairs computed together as array operations, then a far field least squares fit.
+        Bearing is in degrees anticlockwise from forward (x), as for the rover pose.
+        A linear array can't tell front from back so the source is taken to be in front.
+    """
+    def __init__(self, positions=MIC_POSITIONS, sample_rate: int = SAMPLE_RATE, interp: int = 4):
+        self.positions = np.asarray(positions, dtype=np.float64)
+        self.sample_rate = sample_rate
+        self.interp = interp
+        self.pairs = np.array(list(combinations(range(len(positions)), 2)))
+        self.baselines = self.positions[self.pairs[:, 0]] - self.positions[self.pairs[:, 1]]
+        max_distance = np.linalg.norm(self.baselines, axis=1).max()
+        self.max_shift = int(np.ceil(max_distance / SPEED_OF_SOUND * sample_rate * interp))
+        self.linear = np.linalg.matrix_rank(self.baselines) < 2
+        self.pinv = np.linalg.pinv(self.baselines)
+
+    def delays(self, block):
+        """Time difference of arrival, in seconds, for each mic pair (first relative to second)."""
+        n = len(block) * 2
+        spectra = np.fft.rfft(block, n=n, axis=0)
+        cross = spectra[:, self.pairs[:, 0]] * np.conj(spectra[:, self.pairs[:, 1]])
+        cross /= np.abs(cross) + 1e-12
+        cc = np.fft.irfft(cross, n=n * self.interp, axis=0)
+        # Lags -max_shift..max_shift
+        cc = np.concatenate((cc[-self.max_shift:], cc[:self.max_shift + 1]), axis=0)
+        peaks = np.argmax(np.abs(cc), axis=0)
+        confidence = np.abs(cc[peaks, np.arange(cc.shape[1])]).mean()
+        return (peaks - self.max_shift) / (self.sample_rate * self.interp), confidence
+
+    def estimate(self, block):
+        """(bearing degrees, confidence) for a block of (frames, channels) samples."""
+        delays, confidence = self.delays(block.astype(np.float64))
+        # Far field: delay_ij = -(p_i - p_j) . u / c, for u the unit vector towards the source
+        direction = self.pinv @ (-SPEED_OF_SOUND * delays)
+        if self.linear:
+            axis = self.baselines[np.argmax(np.linalg.norm(self.baselines, axis=1))]
+            axis = axis / np.linalg.norm(axis)
+            along = float(np.clip(direction @ axis, -1, 1))
+            normal = np.array([-axis[1], axis[0]])
+            if normal[0] < 0:
+                normal = -normal
+            direction = along * axis + np.sqrt(1 - along ** 2) * normal
+        bearing = float(np.degrees(np.arctan2(direction[1], direction[0])))
+        return bearing, float(confidence)
+
+class AudioSubsystem:
+    """
+        Audio capture into a ring buffer, with a background thread estimating the direction
+        of any speech every HOP_SIZE frames. Estimates are kept in latest_doa and passed to
+        any subscribed callbacks as soon as they are made.
+        source is "mic" for the sound card, otherwise the path of a WAV file to play.
+    """
+    def __init__(self, source: str = "mic", channels: int = CHANNELS, sample_rate: int = SAMPLE_RATE,
+                 positions=MIC_POSITIONS, device=None):
+        self.ring = RingBuffer(sample_rate * RING_SECONDS, channels)
+        if source == "mic":
+            self.source = MicSource(self.ring, sample_rate, device)
+            self.sample_rate = sample_rate
+        else:
+            self.source = WavSource(self.ring, source)
+            self.sample_rate = self.source.sample_rate
+        self.vad = Vad(self.sample_rate)
+        self.estimator = DoaEstimator(positions, self.sample_rate)
+        self.latest_doa = None
+        self.subscribers = []
+        self.running = False
+
+    def subscribe(self, callback):
+        """callback(estimate) is called from the analysis thread for each new estimate."""
+        self.subscribers.append(callback)
+
+    def start(self):
+        self.running = True
+        self.source.start()
+        threading.Thread(target=self.analyse, daemon=True).start()
+
+    def stop(self):
+        self.running = False
+        self.source.stop()
+
+    def analyse(self):
+        position = 0
+        while self.running:
+            if self.ring.written - position < HOP_SIZE:
+                time.sleep(HOP_SIZE / self.sample_rate / 4)
+                continue
+            position = self.ring.written
+            block = self.ring.latest(BLOCK_SIZE)
+            if len(block) < BLOCK_SIZE or not self.vad.is_speech(block.astype(np.float32)):
+                continue
+            bearing, confidence = self.estimator.estimate(block)
+            self.latest_doa = {"bearing": round(bearing, 1), "confidence": round(confidence, 3),
+                               "time": time.monotonic()}
+            for callback in self.subscribers:
+                callback(self.latest_doa)
+
+    def stream(self, chunk: int = HOP_SIZE) -> Iterator[bytes]:
+        """Live audio as a WAV byte stream, header first then interleaved 16 bit chunks."""
+        yield wav_header(self.sample_rate, self.ring.channels)
+        position = self.ring.written
+        while self.running:
+            if self.ring.written - position < chunk:
+                time.sleep(chunk / self.sample_rate / 2)
+                continue
+            frames, position = self.ring.read(position, chunk)
+            yield frames.astype('<i2').tobytes()
+
+def wav_header(sample_rate: int, channels: int) -> bytes:
+    """Header for a 16 bit WAV stream of unknown length."""
+    unknown = 0xFFFFFFFF
+    byte_rate = sample_rate * channels * 2
+    return (b"RIFF" + struct.pack("<I", unknown) + b"WAVE"
+            + b"fmt " + struct.pack("<IHHIIHH", 16, 1, channels, sample_rate, byte_rate, channels * 2, 16)
+            + b"data" + struct.pack("<I", unknown))
+
+def latest_age_ms(estimate: Optional[dict]):
+    return None if estimate is None else round((time.monotonic() - estimate["time"]) * 1000, 1)
@@ -68,9 +68,25 @@ async def dance():
     await send(b'99f')
     await send(b'x')
 
+async def send_now(cmd):
+    print(f"Sending {cmd.decode()}")
+    queue.put(cmd)
+    await asyncio.sleep(0.2)
+
+async def dance_script():
+    # Same dance but uploaded as a script and timed on the rover
+    print("Dance script called")
+    await send_now(b'!c')
+    # One step per packet to keep within the 20 byte BLE write
+    for step in (b'2000:50f;', b'2000:50sr;', b'2000:50b;', b'2000:50sl;', b'2000:99f;'):
+        await send_now(b'!a' + step)
+    await send_now(b'!g')
+    await asyncio.sleep(10)
+    await send(b'x')
+
 async def main():
     await asyncio.gather(
-        ble_connect(dance)
+        ble_connect(dance_script)
     )
 
 try:
@@ -0,0 +1,106 @@
+# Simulated BLE motor bases, stand in for BleakScanner/BleakClient when testing without hardware
+import asyncio
+import random
+import time
+from motor_control import UART_SERVICE_UUID, UART_RX_CHAR_UUID, UART_TX_CHAR_UUID
+
+class SimulatedDevice:
+    """
+        A motor base which records the commands written to it and acknowledges sequenced ones.
+        latency is the simulated one way delay in seconds and loss the probability that
+        a write or a notification is lost.
+    """
+    def __init__(self, name: str, latency: float = 0.0, loss: float = 0.0):
+        self.name = name
+        self.address = f"sim:{name}"
+        self.latency = latency
+        self.loss = loss
+        self.received = []  # (perf_counter time, command) pairs
+        self.client = None
+        self.start = time.monotonic()
+
+    def receive(self, data: bytes):
+        command = data.decode()
+        if command.startswith("#"):
+            seq, _, command = command[1:].partition(":")
+            self.notify(f"A{seq}:{int((time.monotonic() - self.start) * 1000)}".encode())
+        self.received.append((time.perf_counter(), command))
+
+    def notify(self, data: bytes):
+        if self.client is not None and random.random() >= self.loss:
+            asyncio.get_running_loop().call_later(self.latency, self.client.notify, data)
+
+    def disconnect(self):
+        """Simulate the link dropping."""
+        if self.client is not None:
+            self.client.drop()
+
+class SimulatedCharacteristic:
+    def __init__(self, uuid: str):
+        self.uuid = uuid
+
+class SimulatedService:
+    def __init__(self):
+        self.characteristics = {uuid: SimulatedCharacteristic(uuid) for uuid in (UART_RX_CHAR_UUID, UART_TX_CHAR_UUID)}
+
+    def get_characteristic(self, uuid: str):
+        return self.characteristics[uuid]
+
+class SimulatedServices:
+    def __init__(self):
+        self.uart = SimulatedService()
+
+    def get_service(self, uuid: str):
+        return self.uart if uuid == UART_SERVICE_UUID else None
+
+class SimulatedScanner:
+    """Finds the simulated devices by name, in place of BleakScanner."""
+    def __init__(self, devices: list[SimulatedDevice]):
+        self.devices = {device.name: device for device in devices}
+
+    async def find_device_by_name(self, name: str, timeout: float = 10.0):
+        await asyncio.sleep(0)
+        return self.devices.get(name)
+
+class SimulatedClient:
+    """In place of BleakClient, delivers writes to a SimulatedDevice."""
+    def __init__(self, device: SimulatedDevice, disconnected_callback=None):
+        self.device = device
+        self.disconnected_callback = disconnected_callback
+        self.services = SimulatedServices()
+        self.is_connected = False
+        self.notify_callbacks = {}
+
+    async def __aenter__(self):
+        self.is_connected = True
+        self.device.client = self
+        return self
+
+    async def __aexit__(self, *args):
+        await self.disconnect()
+
+    async def write_gatt_char(self, char, data: bytes, response: bool = False):
+        if not self.is_connected:
+            raise ConnectionError(f"{self.device.name} not connected")
+        if self.device.latency:
+            await asyncio.sleep(self.device.latency)
+        if random.random() >= self.device.loss:
+            self.device.receive(bytes(data))
+
+    async def start_notify(self, char, callback):
+        self.notify_callbacks[char.uuid] = (char, callback)
+
+    def notify(self, data: bytes):
+        if self.is_connected and UART_TX_CHAR_UUID in self.notify_callbacks:
+            char, callback = self.notify_callbacks[UART_TX_CHAR_UUID]
+            callback(char, bytearray(data))
+
+    async def disconnect(self):
+        self.is_connected = False
+        self.device.client = None
+
+    def drop(self):
+        self.is_connected = False
+        self.device.client = None
+        if self.disconnected_callback:
+            self.disconnected_callback(self)
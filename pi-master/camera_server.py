@@ -2,29 +2,56 @@
 from picamera2 import Picamera2
 from libcamera import Transform
 from copy import copy
-import cv2
 import asyncio
 import time
 import sys
 import threading
-from typing import Iterator
+from typing import Iterator, Optional
 from fastapi import FastAPI, Response
 from fastapi.responses import HTMLResponse, StreamingResponse
+from pydantic import BaseModel
 import uvicorn
 from contextlib import asynccontextmanager
 import zlib
-from motor_control import MotorController
+from fleet import Fleet
+from jpeg_encoder import make_encoder, yuv420_to_bgr
+from image_pyramid import ImagePyramid, parse_roi
+from video_stream import H264Streamer
+from frames import Frame, LatencyTracker
+from change_detector import ChangeDetector
+from audio import AudioSubsystem, latest_age_ms
 
 # Configuration
 HOST = "0.0.0.0"  # Allow access from any device on the network
 PORT = 8080
 JPEG_QUALITY = 70  # 0-100, higher is better quality but larger size
+JPEG_ENCODER = "auto"  # auto, simplejpeg, turbojpeg or cv2
+ROVERS = ["rover"]  # BLE names of the motor bases, the first is the default
+
+encoder = make_encoder(JPEG_ENCODER)
+# Capture lores as YUV420 if the encoder can use it directly, saves a colour conversion per frame
+LORES_FORMAT = "YUV420" if encoder.supports_yuv else "RGB888"
+H264_SOURCE = "lores"  # lores or main, which stream is sent on /stream-h264, bitrate and GOP are set in video_stream.py
+MAX_FRAME_AGE = 0.5  # seconds, older frames are never sent
+KEEPALIVE_INTERVAL = 1.0  # seconds between stream frames while nothing changes
+AUDIO_SOURCE = "mic"  # "mic", a multi-channel WAV file to play instead, or None for no audio
+
+try:
+    video = H264Streamer()
+except ImportError:
+    print("PyAV not installed, /stream-h264 disabled")
+    video = None
 
 # Global variable for camera and frame handling
 camera = None
 frame_lock = threading.Lock()
-latest_lores = None
-latest_frame = None
+frame_ready = threading.Condition(frame_lock)
+latest = None  # most recent Frame, only the latest is kept
+frame_seq = 0
+pyramid = None
+latency = LatencyTracker()
+change_detector = ChangeDetector()
+audio = None
 stream_active = True
 
 def initialize_camera():
@@ -34,13 +61,13 @@ def initialize_camera():
         camera = Picamera2()
         config = camera.create_still_configuration(buffer_count=2, transform=Transform(vflip=True))
         config["main"] = {'format': 'RGB888', 'size': (1024, 768), "preserve_ar": True}
-        config["lores"] = {'format': 'RGB888', 'size': (320, 240), "preserve_ar": True}
+        config["lores"] = {'format': LORES_FORMAT, 'size': (320, 240), "preserve_ar": True}
         camera.configure(config)
 
         # To do, set up sizes and lores
         camera.start()
         time.sleep(1)
-        print("Camera initialized successfully.")
+        print(f"Camera initialized successfully, lores {LORES_FORMAT}, JPEG encoder {encoder.name}.")
         return True
     except Exception as e:
         print(f"Error initializing camera: {e}")
@@ -48,15 +75,31 @@ def initialize_camera():
 
 def capture_frames():
     """Continuously capture frames from the camera."""
-    global latest_lores, latest_frame, stream_active
+    global latest, frame_seq, stream_active, video
     
     while stream_active:
         (main, lores), metadata = camera.capture_arrays(["main", "lores"])
         if lores is not None:
             # print(f"Captured frame: {lores.shape}")
-            with frame_lock:
-                latest_frame = copy(main)
-                latest_lores = copy(lores)
+            frame_seq += 1
+            frame = Frame(frame_seq, copy(main), copy(lores), metadata)
+            frame.changed = change_detector.update(lores, LORES_FORMAT == "YUV420")
+            frame.change_score = change_detector.score
+            if not frame.changed and latest is not None:
+                frame.last_change_seq = latest.last_change_seq
+            with frame_ready:
+                latest = frame
+                frame_ready.notify_all()
+            if video is not None:
+                try:
+                    if H264_SOURCE == "main":
+                        video.encode(main, False)
+                    else:
+                        video.encode(lores, LORES_FORMAT == "YUV420")
+                except Exception as e:
+                    # Keep capturing for the other endpoints, any H.264 clients time out
+                    print(f"H.264 encoding failed, /stream-h264 disabled: {e}")
+                    video = None
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -67,24 +110,49 @@ async def lifespan(app: FastAPI):
 
 app = FastAPI(title="Pi Rover Camera Server", lifespan=lifespan)
 
+def wait_for_frame(after_seq: int = 0, timeout: float = MAX_FRAME_AGE) -> Optional[Frame]:
+    """
+    Latest frame newer than after_seq and no older than MAX_FRAME_AGE.
+    Frames a slow client missed are skipped, never queued. None if there isn't one within timeout.
+    """
+    deadline = time.monotonic() + timeout
+    with frame_ready:
+        while latest is None or latest.seq <= after_seq or latest.age() > MAX_FRAME_AGE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            frame_ready.wait(remaining)
+        return latest
+
 def generate_frames() -> Iterator[bytes]:
-    """Generate frames for the multipart response."""
-    while True:
-        # Wait until a frame is available
-        if latest_lores is None:
-            time.sleep(0.01)
+    """
+    Generate frames for the multipart response.
+    Frames are only sent when the scene has changed since the last one sent, or as a
+    keepalive every KEEPALIVE_INTERVAL, and each is encoded once for all clients.
+    """
+    seq = 0
+    sent_seq = 0
+    sent_at = 0.0
+    while stream_active:
+        # Wait until a new frame is available
+        frame = wait_for_frame(seq, timeout=1.0)
+        if frame is None:
+            continue
+        seq = frame.seq
+        if frame.last_change_seq <= sent_seq and time.monotonic() - sent_at < KEEPALIVE_INTERVAL:
             continue
-            
-        # Get the current frame
-        with frame_lock:
-            ret, jpeg = cv2.imencode('.jpg', latest_lores, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
-            if ret:
-                # Convert the frame to bytes
-                frame_data = jpeg.tobytes()
+
+        encode_start = time.monotonic()
+        frame_data = frame.cached("lores", lambda: encode_lores(frame.lores))
+        encode_end = time.monotonic()
+        sent_seq = seq
+        sent_at = encode_end
 
         # Yield the frame in the format expected by multipart responses
         yield (b'--frame\r\n'
-               b'Content-Type: image/jpeg\r\n\r\n' + frame_data + b'\r\n')
+               b'Content-Type: image/jpeg\r\n' + frame.part_headers() + b'\r\n' + frame_data + b'\r\n')
+        # Resumed once the part has been handed to the connection
+        latency.record(frame, encode_start, encode_end, time.monotonic())
 
 @app.get("/stream")
 async def stream():
@@ -94,43 +162,151 @@ async def stream():
         media_type="multipart/x-mixed-replace; boundary=frame"
     )
 
+@app.get("/stream-h264")
+async def stream_h264():
+    """
+    Stream the camera feed as raw H.264 (Annex-B), e.g. for ffplay or a browser side jmuxer.
+    Much lower bandwidth than /stream as only keyframes are fully intra-coded.
+    """
+    if video is None:
+        return Response(content="H.264 streaming not available", media_type="text/plain", status_code=503)
+    return StreamingResponse(video.packets(), media_type="video/h264")
+
 @app.get("/still")
-async def still():
-    """Single high-res image."""
-    return await response_for(latest_frame)
+async def still(w: Optional[int] = None, h: Optional[int] = None, q: int = JPEG_QUALITY, roi: Optional[str] = None):
+    """
+    Single high-res image, optionally cropped and scaled.
+    roi is the region to return as x,y,w,h fractions of the frame, w and h the output
+    size (aspect ratio of the region kept if only one is given) and q the JPEG quality.
+    Example: GET /still?w=160&roi=0.25,0.25,0.5,0.5
+    """
+    try:
+        region = parse_roi(roi) if roi else (0.0, 0.0, 1.0, 1.0)
+        if not 1 <= q <= 100 or (w is not None and w < 1) or (h is not None and h < 1):
+            raise ValueError("w, h and q out of range")
+    except ValueError as e:
+        return Response(content=f"Invalid request: {e}", media_type="text/plain", status_code=400)
+
+    if w is None and h is None and roi is None:
+        frame = await asyncio.to_thread(wait_for_frame)
+        return await response_for(frame, q)
+
+    frame = await asyncio.to_thread(wait_for_frame)
+    if frame is None:
+        return no_frame_response()
+    levels = current_pyramid(frame)
+
+    crop_w = region[2] * levels.width
+    crop_h = region[3] * levels.height
+    if w is None and h is None:
+        w, h = crop_w, crop_h
+    elif w is None:
+        w = h * crop_w / crop_h
+    elif h is None:
+        h = w * crop_h / crop_w
+    # Never upscale past the captured resolution
+    scale = min(1.0, crop_w / w, crop_h / h)
+    size = (max(1, int(w * scale)), max(1, int(h * scale)))
+
+    # Blocking resize and encode off the event loop
+    image = await asyncio.to_thread(levels.view, size[0], size[1], region)
+    jpeg = await asyncio.to_thread(encoder.encode, image, q)
+    return Response(content=jpeg, media_type="image/jpeg", headers=frame.headers())
+
+def current_pyramid(frame: Frame):
+    """Pyramid for a high-res frame, shared by all requests until the next capture."""
+    global pyramid
+    with frame_lock:
+        if pyramid is None or pyramid.seq != frame.seq:
+            pyramid = ImagePyramid(frame.main, frame.seq)
+        return pyramid
+
+def no_frame_response():
+    if latest is None:
+        return Response(content="No image available", media_type="text/plain")
+    return Response(content="No recent image available", media_type="text/plain", status_code=503)
 
 @app.get("/still-lores")
 async def still_lores():
     """Single log-res image."""
-    return await response_for(latest_lores)
+    frame = await asyncio.to_thread(wait_for_frame)
+    if frame is None:
+        return no_frame_response()
+
+    return Response(content=encode_lores(frame.lores), media_type="image/jpeg", headers=frame.headers())
 
 @app.get("/still-565")
 async def still_565():
-    frame = latest_lores
+    frame = await asyncio.to_thread(wait_for_frame)
     if frame is None:
-        return Response(content="No image available", media_type="text/plain")
+        return no_frame_response()
 
-    with frame_lock:
-        # Convert the frame to RGB565 format
-        rgb565_frame = frame.astype('uint16')
-        # Implicit RGB to BGR via swapping suffixes instead of using cvtColor
-        rgb565_frame = ((rgb565_frame[:, :, 2] >> 3) << 11) | ((rgb565_frame[:, :, 1] >> 2) << 5) | (rgb565_frame[:, :, 0] >> 3)
-        # Swap the bytes to big-endian format
-        rgb565_bytes = rgb565_frame.byteswap().tobytes()
-        # Compress the RGB565 data using zlib
-        compressed_data = zlib.compress(rgb565_bytes)
-    return Response(content=compressed_data, media_type="application/octet-stream")
+    # Convert the frame to RGB565 format
+    rgb565_frame = lores_bgr(frame.lores).astype('uint16')
+    # Implicit RGB to BGR via swapping suffixes instead of using cvtColor
+    rgb565_frame = ((rgb565_frame[:, :, 2] >> 3) << 11) | ((rgb565_frame[:, :, 1] >> 2) << 5) | (rgb565_frame[:, :, 0] >> 3)
+    # Swap the bytes to big-endian format
+    rgb565_bytes = rgb565_frame.byteswap().tobytes()
+    # Compress the RGB565 data using zlib
+    compressed_data = zlib.compress(rgb565_bytes)
+    return Response(content=compressed_data, media_type="application/octet-stream", headers=frame.headers())
     
-async def response_for(frame):
+async def response_for(frame: Optional[Frame], quality: int = JPEG_QUALITY):
     if frame is None:
-        return Response(content="No image available", media_type="text/plain")
+        return no_frame_response()
 
-    with frame_lock:
-        ret, jpeg = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
-        if ret:
-            return Response(content=jpeg.tobytes(), media_type="image/jpeg")
-        else:
-            return Response(content="Failed to encode image", media_type="text/plain")
+    try:
+        return Response(content=encoder.encode(frame.main, quality), media_type="image/jpeg", headers=frame.headers())
+    except RuntimeError:
+        return Response(content="Failed to encode image", media_type="text/plain")
+
+@app.get("/change")
+async def change():
+    """Change score of the latest frame (mean absolute luma difference, 0-255) for other consumers."""
+    if latest is None:
+        return {"seq": None}
+    return {
+        "seq": latest.seq,
+        "score": latest.change_score,
+        "changed": latest.changed,
+        "last_change_seq": latest.last_change_seq,
+    }
+
+@app.get("/audio-stream")
+async def audio_stream():
+    """Stream the microphone channels as 16 bit WAV."""
+    if audio is None:
+        return Response(content="Audio not available", media_type="text/plain", status_code=503)
+    return StreamingResponse(audio.stream(), media_type="audio/wav")
+
+@app.get("/doa")
+async def doa():
+    """Latest direction of arrival of speech, bearing in degrees anticlockwise from forward."""
+    if audio is None:
+        return {"status": "error", "message": "Audio not available"}
+    estimate = audio.latest_doa
+    if estimate is None:
+        return {"bearing": None}
+    return {"bearing": estimate["bearing"], "confidence": estimate["confidence"], "age_ms": latest_age_ms(estimate)}
+
+@app.get("/latency")
+async def latency_stats():
+    """Per-stage latency percentiles over recently streamed frames, and the age of the latest frame."""
+    return {
+        "latest_seq": latest.seq if latest else None,
+        "latest_age_ms": round(latest.age() * 1000, 1) if latest else None,
+        "stages": latency.summary(),
+    }
+
+def encode_lores(frame, quality: int = JPEG_QUALITY) -> bytes:
+    """Encode a lores frame, straight from the YUV planes if the lores stream is YUV420."""
+    if LORES_FORMAT == "YUV420":
+        return encoder.encode_yuv420(frame, quality)
+    return encoder.encode(frame, quality)
+
+def lores_bgr(frame):
+    """Lores frame as a BGR array, whatever format it was captured in."""
+    return yuv420_to_bgr(frame) if LORES_FORMAT == "YUV420" else frame
 
 @app.get("/", response_class=HTMLResponse)
 async def index():
@@ -182,28 +358,115 @@ async def index():
     """
     return HTMLResponse(content=html_content)
 
-motor = MotorController()
+fleet = Fleet(ROVERS)
+
+def rover_for(rover: Optional[str]):
+    """The named motor base, or the default one, None if there isn't one of that name."""
+    if rover is None:
+        return fleet.default
+    return fleet[rover] if rover in fleet else None
 
 @app.post("/set-motor")
-async def set_motor(s: int, dir: str):
+async def set_motor(s: int, dir: str, rover: Optional[str] = None):
     """
-    Set the speed and direction of the motor
-    Example: POST /set-motor?s=50&dir=f
+    Set the speed and direction of the motor, on the named rover or all of them
+    Example: POST /set-motor?s=50&dir=f&rover=all
     """
     try:
+        if rover == "all":
+            sent = await fleet.broadcast(s, dir)
+            return {"status": "success", "message": f"Motors set to dir={dir}, speed={s} on {', '.join(sent)}"}
+        motor = rover_for(rover)
+        if motor is None:
+            return {"status": "error", "message": f"Unknown rover {rover}"}
         if motor.is_connected:
-            if dir == "s":
-                motor.queue.append(dir)
-            else:
-                motor.queue.append(f"{s}{dir}")
+            motor.send(s, dir)
             return {"status": "success", "message": f"Motor set to dir={dir}, speed={s}"}
         else:
             return {"status": "error", "message": "Motor base BLE connection not ready"}
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
+@app.get("/fleet")
+async def fleet_status():
+    """Connection state and stats for each motor base."""
+    return fleet.status()
+
+@app.get("/pose")
+async def pose(rover: Optional[str] = None):
+    """Dead reckoned pose from the motor base odometry, x and y in mm, heading in radians."""
+    motor = rover_for(rover)
+    if motor is None:
+        return {"status": "error", "message": f"Unknown rover {rover}"}
+    x, y, heading = motor.pose
+    return {"x": x, "y": y, "heading": heading}
+
+@app.post("/pose/reset")
+async def reset_pose(rover: Optional[str] = None):
+    """Reset the odometry to the origin"""
+    motor = rover_for(rover)
+    if motor is None or not motor.is_connected:
+        return {"status": "error", "message": "Motor base BLE connection not ready"}
+    motor.reset_pose()
+    return {"status": "success", "message": "Pose reset"}
+
+class ScriptStep(BaseModel):
+    duration_ms: int
+    speed: int = 50
+    motion: str
+
+@app.post("/script")
+async def upload_script(steps: list[ScriptStep], rover: Optional[str] = None):
+    """
+    Upload a motion script to run on the motor base, replacing any previous one
+    Example: POST /script [{"duration_ms": 2000, "speed": 50, "motion": "f"}, ...]
+    """
+    motor = rover_for(rover)
+    if motor is None or not motor.is_connected:
+        return {"status": "error", "message": "Motor base BLE connection not ready"}
+    try:
+        motor.upload_script([(step.duration_ms, step.speed, step.motion) for step in steps])
+    except ValueError as e:
+        return {"status": "error", "message": str(e)}
+    return {"status": "success", "message": f"Uploaded script of {len(steps)} steps"}
+
+@app.post("/script/{action}")
+async def control_script(action: str, rover: Optional[str] = None):
+    """
+    Control the uploaded motion script, action is start, pause, resume or abort
+    Example: POST /script/start
+    """
+    motor = rover_for(rover)
+    if motor is None:
+        return {"status": "error", "message": f"Unknown rover {rover}"}
+    actions = {
+        "start": motor.start_script,
+        "pause": motor.pause_script,
+        "resume": motor.resume_script,
+        "abort": motor.abort_script,
+    }
+    if action not in actions:
+        return {"status": "error", "message": f"Unknown script action {action}"}
+    if not motor.is_connected:
+        return {"status": "error", "message": "Motor base BLE connection not ready"}
+    actions[action]()
+    return {"status": "success", "message": f"Script {action}"}
+
+def start_audio():
+    global audio
+    if AUDIO_SOURCE is None:
+        return
+    try:
+        audio = AudioSubsystem(AUDIO_SOURCE)
+        audio.start()
+        print(f"Audio capture started from {AUDIO_SOURCE}.")
+    except Exception as e:
+        print(f"Audio not available: {e}")
+        audio = None
+
 async def startup():
     """Initialize camera and start frame capture thread on startup."""
+    start_audio()
     if not initialize_camera():
         print("Failed to initialize camera. The stream will not work.")
         return
@@ -213,18 +476,20 @@ async def startup():
     capture_thread.start()
     print("Camera capture thread started.")
     # Start BLE connection listener
-    print("Starting BLE connection to motor base in background")
-    asyncio.create_task(motor.run())
+    print("Starting BLE connections to motor bases in background")
+    fleet.start()
 
 
 async def shutdown():
     """Release camera resources on shutdown."""
+    global stream_active
     stream_active = False
+    if audio is not None:
+        audio.stop()
     if camera is not None:
         camera.stop()
         print("Camera stopped.")
-    if motor.is_connected:
-        motor.shutdown()
+    await fleet.shutdown()
 
 def main():
     """Main function to start the FastAPI server with Uvicorn."""
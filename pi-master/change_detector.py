@@ -0,0 +1,43 @@
+# Cheap frame change detection on a heavily downsampled copy of the lores frame
+import numpy as np
+
+DOWNSAMPLE = 8  # average 8x8 blocks, 320x240 -> 40x30
+CHANGE_THRESHOLD = 2.0  # mean absolute luma difference (0-255) counted as a change
+
+class ChangeDetector:
+    """
+        Scores how much a frame differs from the last frame that was counted as changed.
+        Comparing against that reference, rather than the previous frame, means slow drifts
+        (e.g. lighting) still add up to a change eventually.
+        Works on luma only: the Y plane of YUV420 frames or the green channel of BGR ones.
+    """
+    def __init__(self, threshold: float = CHANGE_THRESHOLD, downsample: int = DOWNSAMPLE):
+        self.threshold = threshold
+        self.downsample = downsample
+        self.reference = None
+        self.score = 0.0
+
+    def thumbnail(self, frame, yuv420: bool):
+        """Luma averaged over blocks, which also averages out sensor noise that would otherwise look like change."""
+        step = self.downsample
+        if yuv420:
+            luma = frame[:frame.shape[0] * 2 // 3]
+        else:
+            luma = frame[:, :, 1]
+        height = luma.shape[0] // step
+        width = luma.shape[1] // step
+        blocks = luma[:height * step, :width * step].reshape(height, step, width, step)
+        return blocks.mean(axis=(1, 3), dtype=np.float32)
+
+    def update(self, frame, yuv420: bool) -> bool:
+        """Score frame against the reference, returns True (and makes it the reference) if it has changed."""
+        thumbnail = self.thumbnail(frame, yuv420)
+        if self.reference is None or self.reference.shape != thumbnail.shape:
+            self.reference = thumbnail
+            self.score = 255.0
+            return True
+        self.score = float(np.abs(thumbnail - self.reference).mean())
+        if self.score >= self.threshold:
+            self.reference = thumbnail
+            return True
+        return False
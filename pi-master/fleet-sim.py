@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# Exercise the fleet manager against simulated motor bases, reports broadcast skew and reconnects
+import asyncio
+import sys
+from ble_sim import SimulatedDevice, SimulatedScanner, SimulatedClient
+from fleet import Fleet
+
+ROVERS = 4
+BROADCASTS = 50
+
+async def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else ROVERS
+    devices = [SimulatedDevice(f"rover{i}", latency=0.005) for i in range(count)]
+    fleet = Fleet([device.name for device in devices], SimulatedClient, SimulatedScanner(devices))
+    fleet.start()
+    while not all(rover.is_connected for rover in fleet.rovers.values()):
+        await asyncio.sleep(0.01)
+    print(f"{count} simulated rovers connected")
+
+    skews = []
+    for i in range(BROADCASTS):
+        await fleet.broadcast(50, "f" if i % 2 else "b")
+        # Skew as seen by the rovers, i.e. spread of the arrival times of this command
+        arrivals = [device.received[-1][0] for device in devices]
+        skews.append((max(arrivals) - min(arrivals)) * 1000)
+    skews.sort()
+    print(f"Broadcast arrival skew ms: median {skews[len(skews) // 2]:.3f}, max {skews[-1]:.3f}")
+
+    # Individually addressed commands go through each rover's own queue
+    fleet["rover0"].send(30, "rr")
+    await asyncio.sleep(0.05)
+    print(f"rover0 last command: {devices[0].received[-1][1]}")
+
+    # Drop a link and check the supervisor reconnects
+    devices[1].disconnect()
+    await asyncio.sleep(1.5)
+    print(f"rover1 reconnected: {fleet['rover1'].is_connected}")
+
+    # Lossy link, stops must still get through
+    lossy = fleet["rover2"]
+    devices[2].loss = 0.3
+    for i in range(20):
+        lossy.send(40, "f")
+        await asyncio.sleep(0.05)
+        lossy.send(0, "s")
+        await asyncio.sleep(0.3)
+        print(f"rover2 stop {i}: {'ok' if devices[2].received[-1][1] == 's' else 'LOST'}")
+    print(f"rover2 link {lossy.link_stats()}")
+
+    await fleet.shutdown()
+    print(fleet.status()["fleet"])
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,71 @@
+# Manage several motor bases from one event loop
+import asyncio
+import time
+from bleak import BleakClient, BleakScanner
+from motor_control import MotorController
+
+class Fleet:
+    """
+        A set of motor bases, each with its own MotorController (command queue and stats)
+        kept connected by its own supervisor task.
+        Rovers are addressed by their BLE device name.
+    """
+    def __init__(self, names: list[str], client_factory=BleakClient, scanner=BleakScanner):
+        self.rovers = {name: MotorController(name, client_factory, scanner) for name in names}
+        self.tasks = []
+        self.stats = {"broadcasts": 0, "last_skew_ms": 0.0, "max_skew_ms": 0.0}
+
+    def __getitem__(self, name: str) -> MotorController:
+        return self.rovers[name]
+
+    def __contains__(self, name: str):
+        return name in self.rovers
+
+    @property
+    def default(self) -> MotorController:
+        """The first rover, used when a request doesn't name one."""
+        return next(iter(self.rovers.values()))
+
+    def start(self):
+        """Start a connection supervisor for every rover on the running event loop."""
+        self.tasks = [asyncio.create_task(rover.supervise()) for rover in self.rovers.values()]
+
+    async def broadcast(self, speed: int, dir: str) -> list[str]:
+        """
+            Send the same command to every connected rover, returning the names it was sent to.
+            The writes bypass the per-rover queues and are all issued in the same event loop
+            pass, so the skew between rovers is just the time to hand each write to the BLE stack.
+            Any command still queued for a rover is older, so it is discarded rather than sent after.
+            A stop is resent until acknowledged, as for a single rover.
+        """
+        command = "s" if dir == "s" else f"{speed}{dir}"
+        targets = [rover for rover in self.rovers.values() if rover.is_connected]
+        issued = []
+
+        async def write(rover):
+            rover.queue.clear()
+            issued.append(time.perf_counter())
+            await rover.write(command)
+
+        results = await asyncio.gather(*(write(rover) for rover in targets), return_exceptions=True)
+        if len(issued) > 1:
+            skew = (max(issued) - min(issued)) * 1000
+            self.stats["last_skew_ms"] = skew
+            self.stats["max_skew_ms"] = max(skew, self.stats["max_skew_ms"])
+        self.stats["broadcasts"] += 1
+        return [rover.name for rover, result in zip(targets, results) if not isinstance(result, Exception)]
+
+    def status(self):
+        return {
+            "fleet": self.stats,
+            "rovers": {name: {"connected": rover.is_connected, **rover.link_stats()} for name, rover in self.rovers.items()},
+        }
+
+    async def shutdown(self):
+        for rover in self.rovers.values():
+            rover.shutdown()
+        if self.tasks:
+            _, pending = await asyncio.wait(self.tasks, timeout=2)
+            # Still scanning or connecting
+            for task in pending:
+                task.cancel()
@@ -0,0 +1,90 @@
+# Captured frames with their timestamps, and per-stage latency tracking
+import threading
+import time
+from collections import deque
+
+LATENCY_WINDOW = 300  # frames kept for the latency stats
+STAGES = ["capture", "queue", "encode", "send"]
+
+class Frame:
+    """
+        One capture of both streams.
+        timestamp is the sensor timestamp from the picamera2 metadata, in seconds on the
+        time.monotonic clock (the kernel clock libcamera uses, the Pi never suspends so the
+        boot and monotonic clocks agree). captured is when capture_arrays returned it.
+    """
+    def __init__(self, seq: int, main, lores, metadata: dict):
+        self.seq = seq
+        self.main = main
+        self.lores = lores
+        self.captured = time.monotonic()
+        sensor_timestamp = metadata.get("SensorTimestamp") if metadata else None
+        self.timestamp = sensor_timestamp / 1e9 if sensor_timestamp else self.captured
+        # Set by the change detector, last_change_seq is the most recent frame that changed
+        self.change_score = 0.0
+        self.changed = True
+        self.last_change_seq = seq
+        self._cache = {}
+        self._cache_lock = threading.Lock()
+
+    def cached(self, key, make):
+        """Result of make() computed once per frame, e.g. an encoding shared by all clients."""
+        with self._cache_lock:
+            if key not in self._cache:
+                self._cache[key] = make()
+            return self._cache[key]
+
+    def age(self) -> float:
+        """Seconds since the frame was exposed."""
+        return time.monotonic() - self.timestamp
+
+    def headers(self) -> dict:
+        return {
+            "X-Frame-Seq": str(self.seq),
+            "X-Frame-Timestamp": f"{self.timestamp:.6f}",
+            "X-Frame-Age-Ms": f"{self.age() * 1000:.1f}",
+            "X-Change-Score": f"{self.change_score:.2f}",
+        }
+
+    def part_headers(self) -> bytes:
+        """Headers for a multipart part, as bytes."""
+        return b"".join(f"{name}: {value}\r\n".encode() for name, value in self.headers().items())
+
+class LatencyTracker:
+    """
+        Recent per-frame stage timings in seconds:
+            - capture - sensor timestamp to capture_arrays returning
+            - queue   - waiting from capture until picked up for encoding
+            - encode  - JPEG encoding
+            - send    - handing the encoded frame to the client connection
+    """
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self.records = deque([], window)
+        self.lock = threading.Lock()
+
+    def record(self, frame: Frame, encode_start: float, encode_end: float, send_end: float):
+        timings = {
+            "seq": frame.seq,
+            "capture": frame.captured - frame.timestamp,
+            "queue": encode_start - frame.captured,
+            "encode": encode_end - encode_start,
+            "send": send_end - encode_end,
+            "total": send_end - frame.timestamp,
+        }
+        with self.lock:
+            self.records.append(timings)
+
+    def summary(self) -> dict:
+        """p50/p90/p99 in ms for each stage and end to end."""
+        with self.lock:
+            records = list(self.records)
+        summary = {"frames": len(records)}
+        if not records:
+            return summary
+        for stage in STAGES + ["total"]:
+            values = sorted(r[stage] for r in records)
+            summary[stage] = {
+                f"p{p}_ms": round(values[min(len(values) - 1, len(values) * p // 100)] * 1000, 1)
+                for p in (50, 90, 99)
+            }
+        return summary
@@ -0,0 +1,68 @@
+# Lazily built image pyramid for serving stills at arbitrary size and crop
+import math
+import threading
+import cv2
+
+class ImagePyramid:
+    """
+        Halving pyramid over one captured frame.
+        Levels are only computed when first needed, with area interpolation, and then
+        shared by every request for the same frame. A resized view is cut from the
+        smallest level that still has at least the requested resolution.
+    """
+    def __init__(self, frame, seq: int):
+        self.seq = seq
+        self.levels = [frame]
+        self.lock = threading.Lock()
+
+    @property
+    def width(self):
+        return self.levels[0].shape[1]
+
+    @property
+    def height(self):
+        return self.levels[0].shape[0]
+
+    def level(self, n: int):
+        """Level n, 1/2^n of the full size, building any missing levels on the way."""
+        with self.lock:
+            while len(self.levels) <= n:
+                prev = self.levels[-1]
+                size = (max(1, prev.shape[1] // 2), max(1, prev.shape[0] // 2))
+                self.levels.append(cv2.resize(prev, size, interpolation=cv2.INTER_AREA))
+            return self.levels[n]
+
+    def view(self, width: int, height: int, roi=(0.0, 0.0, 1.0, 1.0)):
+        """
+            Region of interest scaled to width x height.
+            roi is (x, y, w, h) as fractions of the full frame.
+        """
+        x, y, w, h = roi
+        crop_w = w * self.width
+        crop_h = h * self.height
+        # Go down the pyramid while the crop would still be at least the requested size
+        n = 0
+        while crop_w / 2 ** (n + 1) >= width and crop_h / 2 ** (n + 1) >= height:
+            n += 1
+        image = self.level(n)
+        lh, lw = image.shape[:2]
+        left, top = int(x * lw), int(y * lh)
+        right = max(left + 1, min(lw, int(round((x + w) * lw))))
+        bottom = max(top + 1, min(lh, int(round((y + h) * lh))))
+        image = image[top:bottom, left:right]
+        if image.shape[1] == width and image.shape[0] == height:
+            return image
+        interpolation = cv2.INTER_AREA if image.shape[1] >= width else cv2.INTER_LINEAR
+        return cv2.resize(image, (width, height), interpolation=interpolation)
+
+def parse_roi(roi: str):
+    """Parse "x,y,w,h" fractions of the frame, raising ValueError if malformed or out of range."""
+    parts = [float(p) for p in roi.split(",")]
+    if len(parts) != 4:
+        raise ValueError("roi must be x,y,w,h")
+    x, y, w, h = parts
+    if not all(math.isfinite(p) for p in parts):
+        raise ValueError("roi must be finite")
+    if x < 0 or y < 0 or w <= 0 or h <= 0 or x + w > 1 + 1e-6 or y + h > 1 + 1e-6:
+        raise ValueError("roi must lie within 0-1")
+    return x, y, w, h
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# Compare JPEG encoder backends, reports frames per second per core (i.e. per CPU second)
+import sys
+import time
+import cv2
+import numpy as np
+from jpeg_encoder import available_encoders
+
+QUALITY = 70
+FRAMES = 200
+SIZES = [(320, 240), (1024, 768)]
+
+def test_image(width, height):
+    """Smooth gradient plus noise, closer to a camera image than pure noise."""
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    bgr = np.dstack([x + 0 * y, y + 0 * x, (x + y) / 2])
+    bgr += np.random.default_rng(0).normal(0, 8, bgr.shape)
+    bgr = np.clip(bgr, 0, 255).astype(np.uint8)
+    return bgr, cv2.cvtColor(bgr, cv2.COLOR_BGR2YUV_I420)
+
+def bench(encode, frame, frames):
+    encode(frame, QUALITY)  # warm up
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    for _ in range(frames):
+        size = len(encode(frame, QUALITY))
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    return frames / wall, frames / cpu, size
+
+def main():
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else FRAMES
+    encoders = available_encoders()
+    print(f"Encoders available: {', '.join(e.name for e in encoders)}")
+    print(f"{'encoder':<12}{'input':<8}{'size':<11}{'fps':>8}{'fps/core':>10}{'bytes':>9}")
+    for width, height in SIZES:
+        bgr, yuv = test_image(width, height)
+        for encoder in encoders:
+            inputs = [("BGR", encoder.encode, bgr), ("YUV420", encoder.encode_yuv420, yuv)]
+            for input_name, encode, frame in inputs:
+                fps, fps_core, size = bench(encode, frame, frames)
+                print(f"{encoder.name:<12}{input_name:<8}{f'{width}x{height}':<11}{fps:>8.1f}{fps_core:>10.1f}{size:>9}")
+
+if __name__ == "__main__":
+    main()
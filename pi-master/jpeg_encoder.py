@@ -0,0 +1,110 @@
+# Pluggable JPEG encoder backends for the camera server
+import cv2
+
+class JpegEncoder:
+    """
+        Base class for JPEG encoders.
+        Frames are either BGR arrays (picamera2 "RGB888") or YUV420 arrays as returned
+        by picamera2 for a "YUV420" stream, i.e. shape (height*3/2, width) with the
+        Y plane followed by the U and V planes.
+        Backends that can encode the YUV planes directly set supports_yuv.
+    """
+    name = "base"
+    supports_yuv = False
+
+    def encode(self, frame, quality: int) -> bytes:
+        raise NotImplementedError
+
+    def encode_yuv420(self, frame, quality: int) -> bytes:
+        return self.encode(yuv420_to_bgr(frame), quality)
+
+class Cv2Encoder(JpegEncoder):
+    """Fallback encoder using OpenCV, always available."""
+    name = "cv2"
+
+    def encode(self, frame, quality: int) -> bytes:
+        ret, jpeg = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        if not ret:
+            raise RuntimeError("Failed to encode image")
+        return jpeg.tobytes()
+
+class SimpleJpegEncoder(JpegEncoder):
+    """libjpeg-turbo encoder via simplejpeg, encodes YUV420 planes without colour conversion."""
+    name = "simplejpeg"
+    supports_yuv = True
+
+    def __init__(self):
+        import simplejpeg
+        self._simplejpeg = simplejpeg
+
+    def encode(self, frame, quality: int) -> bytes:
+        return self._simplejpeg.encode_jpeg(frame, quality=quality, colorspace='BGR')
+
+    def encode_yuv420(self, frame, quality: int) -> bytes:
+        y, u, v = yuv420_planes(frame)
+        return self._simplejpeg.encode_jpeg_yuv_planes(y, u, v, quality=quality)
+
+class TurboJpegEncoder(JpegEncoder):
+    """libjpeg-turbo encoder via PyTurboJPEG, encodes the packed YUV420 buffer directly."""
+    name = "turbojpeg"
+    supports_yuv = True
+
+    def __init__(self):
+        from turbojpeg import TurboJPEG, TJSAMP_420
+        self._turbo = TurboJPEG()
+        self._subsample = TJSAMP_420
+
+    def encode(self, frame, quality: int) -> bytes:
+        return self._turbo.encode(frame, quality=quality)
+
+    def encode_yuv420(self, frame, quality: int) -> bytes:
+        height = frame.shape[0] * 2 // 3
+        width = frame.shape[1]
+        return self._turbo.encode_from_yuv(frame, height, width, quality=quality,
+                                           jpeg_subsample=self._subsample)
+
+# In order of preference when choosing automatically
+ENCODERS = {
+    "simplejpeg": SimpleJpegEncoder,
+    "turbojpeg": TurboJpegEncoder,
+    "cv2": Cv2Encoder,
+}
+
+def available_encoders() -> list[JpegEncoder]:
+    """Instances of all the encoders whose libraries are installed."""
+    encoders = []
+    for cls in ENCODERS.values():
+        try:
+            encoders.append(cls())
+        except (ImportError, OSError, RuntimeError):
+            pass
+    return encoders
+
+def make_encoder(name: str = "auto") -> JpegEncoder:
+    """
+        Create the named encoder, or the fastest available one for "auto".
+        Falls back to cv2 if the requested library is not installed or the name is unknown.
+    """
+    names = list(ENCODERS) if name == "auto" else [name, "cv2"]
+    for candidate in names:
+        try:
+            return ENCODERS[candidate]()
+        except KeyError:
+            print(f"Unknown JPEG encoder {candidate}, falling back")
+        except (ImportError, OSError, RuntimeError) as e:
+            if name != "auto":
+                print(f"JPEG encoder {candidate} not available ({e}), falling back")
+    return Cv2Encoder()
+
+def yuv420_planes(frame):
+    """Split a picamera2 YUV420 array into its Y, U and V planes."""
+    height = frame.shape[0] * 2 // 3
+    width = frame.shape[1]
+    y = frame[:height]
+    # The chroma planes are stored row-packed, two half-width rows per array row
+    chroma = frame[height:].reshape(2, height // 2, width // 2)
+    return y, chroma[0], chroma[1]
+
+def yuv420_to_bgr(frame):
+    """Convert a picamera2 YUV420 array to BGR, as used by RGB888 streams."""
+    return cv2.cvtColor(frame, cv2.COLOR_YUV2BGR_I420)
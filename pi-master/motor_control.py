@@ -5,11 +5,37 @@ from bleak.backends.characteristic import BleakGATTCharacteristic
 from bleak.backends.device import BLEDevice
 from bleak.backends.scanner import AdvertisementData
 import asyncio
+import random
+import time
 from collections import deque
 
 UART_SERVICE_UUID = "6E400001-B5A3-F393-E0A9-E50E24DCCA9E"
 UART_RX_CHAR_UUID = "6E400002-B5A3-F393-E0A9-E50E24DCCA9E"
 UART_TX_CHAR_UUID = "6E400003-B5A3-F393-E0A9-E50E24DCCA9E"
+BLE_PACKET_SIZE = 20
+SEQ_MODULUS = 10000
+SEQ_HEADER_SIZE = len(f"#{SEQ_MODULUS - 1}:")
+RTT_WINDOW = 200  # acknowledged commands kept for the percentiles
+MAX_IN_FLIGHT = 4
+MIN_SEND_INTERVAL = 0.02  # seconds
+MAX_SEND_INTERVAL = 0.5
+SEND_INTERVAL_RECOVERY = 0.8  # send interval multiplier per acknowledged command
+BACKOFF_TIMEOUTS = 4  # loss only slows sends to one per this many retransmission timeouts
+INITIAL_TIMEOUT = 0.3  # retransmission timeout before there are any round trip times
+MIN_TIMEOUT = 0.05
+MAX_TIMEOUT = 1.0
+MAX_ATTEMPTS = 20
+DUPLICATE_WINDOW = 128  # as RECENT_SEQS on the motor base, never resend once this many newer commands are sent
+MOTIONS = {"f", "b", "sr", "sl", "dr", "dl", "Dr", "Dl", "tr", "tl", "Tr", "Tl", "rr", "rl", "s"}
+MAX_SCRIPT_STEPS = 64  # as MAX_STEPS on the motor base
+
+class PendingCommand:
+    """A command sent but not yet acknowledged."""
+    def __init__(self, command: str, reliable: bool):
+        self.command = command
+        self.reliable = reliable
+        self.sent_at = 0.0
+        self.attempts = 0
 
 class MotorController:
     """
@@ -22,50 +48,289 @@ class MotorController:
             - tr tl Tr Tl - turn right/left turn back right/left
             - rr rl       - rotate right or left
             - s           - stop
+        Motion scripts, a list of (duration_ms, speed, motion) steps, are uploaded and then
+        run on the motor base itself so their timing doesn't depend on the BLE link.
+        Each command is sent as "#<seq>:<command>" and acknowledged by the motor base
+        with "A<seq>:<ticks_ms>" notified on the TX characteristic.
+        The motor base also notifies pose changes "O<dx>,<dy>,<dheading>" from its odometry
+        which are summed into pose, (x, y) in mm and heading in radians anticlockwise.
     """
-    def __init__(self):
-        # Short length queue of commands to send
-        self.queue = deque([], 2)
+    def __init__(self, name: str = 'rover', client_factory=BleakClient, scanner=BleakScanner):
+        self.name = name
+        # BLE classes can be swapped for simulated ones, see ble_sim.py
+        self.client_factory = client_factory
+        self.scanner = scanner
+        # Only the latest motion command is sent, a newer one replaces any still waiting
+        self.queue = deque([], 1)
+        # Commands which must all be sent, in order, ahead of the motion commands
+        self.control_queue = deque()
+        self.wakeup = asyncio.Event()
         self.is_connected = False
-        
-    async def run(self):
-        print('Scanning for devices...')
-        device = await BleakScanner.find_device_by_name('rover', 36000.0)
+        self.stopping = False
+        self.client = None
+        self.rx = None
+        # Random start so a restarted controller doesn't reuse sequence numbers the motor base just saw
+        self.next_seq = random.randrange(SEQ_MODULUS)
+        self.pending = {}  # seq -> PendingCommand
+        self.rtts = deque([], RTT_WINDOW)
+        self.send_interval = MIN_SEND_INTERVAL
+        self.last_sent = 0.0
+        self.last_backoff = 0.0
+        self.pose = [0.0, 0.0, 0.0]
+        # While a "!o" is queued or unacknowledged pose changes are from before the reset so ignored
+        self.pose_reset = False
+        self.pose_reset_seq = None
+        self.stats = {"connects": 0, "disconnects": 0, "sent": 0, "errors": 0,
+                      "acked": 0, "lost": 0, "resent": 0, "last_applied_ms": None}
+
+    async def supervise(self, retry_delay: float = 1.0, max_retry_delay: float = 30.0):
+        """Keep the connection up, reconnecting with backoff, until shutdown."""
+        delay = retry_delay
+        while not self.stopping:
+            try:
+                if await self.run(exit_if_not_found=False):
+                    delay = retry_delay
+            except Exception as e:
+                print(f"{self.name}: connection failed: {e}")
+                self.stats["errors"] += 1
+            if self.stopping:
+                break
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, max_retry_delay)
+
+    async def run(self, exit_if_not_found: bool = True) -> bool:
+        """Connect and send queued commands until disconnected, returns False if the device wasn't found."""
+        print(f'Scanning for {self.name}...')
+        device = await self.scanner.find_device_by_name(self.name, 36000.0 if exit_if_not_found else 10.0)
         if (device is None):
-            print('Device not found')
-            sys.exit(1)
-            return  
+            print(f'{self.name} not found')
+            if exit_if_not_found:
+                sys.exit(1)
+            return False
         print(f'Connecting to {device.name}')
 
-        async with BleakClient(device, disconnected_callback=self.handle_disconnect) as client:
-            print('Connected to rover')
-            self.is_connected = True
+        async with self.client_factory(device, disconnected_callback=self.handle_disconnect) as client:
+            print(f'Connected to {self.name}')
+            self.stats["connects"] += 1
+            # Anything queued or in flight while disconnected is stale, apart from a pose reset
+            if self.pose_reset_seq in self.pending:
+                self.control_queue.appendleft("!o")
+            self.queue.clear()
+            self.pending.clear()
             rover = client.services.get_service(UART_SERVICE_UUID)
-            rx = rover.get_characteristic(UART_RX_CHAR_UUID)
-
-            while True:
-                # Check if there's a command in the queue without blocking
-                try:
-                    command = self.queue.pop()
-                    if command == 'x':
-                        print('Quit requested')
-                        self.is_connected = False
-                        client.disconnect()
-                        break
-                    print(f"Sending {command}")
-                    await client.write_gatt_char(rx, command.encode(), response=False)
-                except IndexError:
-                    # Give control back to the event loop to allow other tasks to run
-                    await asyncio.sleep(0.01)
+            self.rx = rover.get_characteristic(UART_RX_CHAR_UUID)
+            await client.start_notify(rover.get_characteristic(UART_TX_CHAR_UUID), self.handle_notify)
+            self.client = client
+            self.is_connected = True
+
+            while self.is_connected:
+                await self.check_timeouts()
+                command = self.next_command()
+                if command is None:
+                    # Give control back to the event loop until a command is queued or is due
+                    self.wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), 0.01)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                if command == 'x':
+                    print('Quit requested')
+                    self.is_connected = False
+                    await client.disconnect()
+                    break
+                print(f"Sending {command}")
+                await self.write(command)
+            self.client = None
+        return True
+
+    def next_command(self):
+        """
+            Next command to send, if the link can take one now.
+            Sends are spaced by the adaptive send interval, control commands are sent one
+            at a time once the previous one is acknowledged and motion commands are limited
+            to MAX_IN_FLIGHT unacknowledged. A stop skips all of that and goes straight away.
+        """
+        if self.queue and self.queue[0] == "s":
+            return self.queue.popleft()
+        if time.monotonic() - self.last_sent < self.send_interval:
+            return None
+        if self.control_queue:
+            if not any(p.reliable for p in self.pending.values()):
+                return self.control_queue.popleft()
+        elif self.queue and len(self.pending) < MAX_IN_FLIGHT:
+            return self.queue.popleft()
+        return None
+
+    async def write(self, command: str):
+        """
+            Write a command straight to the motor base with the next sequence number, bypassing the queue.
+            Stops and control commands are resent until acknowledged, other motion commands
+            are superseded by the next one so are not.
+        """
+        seq = self.next_seq
+        self.next_seq = (self.next_seq + 1) % SEQ_MODULUS
+        reliable = command == "s" or command.startswith("!")
+        if not command.startswith("!"):
+            # A newer motion command supersedes any stop still being resent
+            for old_seq in [s for s, p in self.pending.items() if p.command == "s"]:
+                del self.pending[old_seq]
+        if command == "!o":
+            self.pose_reset_seq = seq
+        self.pending[seq] = PendingCommand(command, reliable)
+        await self.transmit(seq)
+
+    async def transmit(self, seq: int):
+        pending = self.pending[seq]
+        pending.sent_at = time.monotonic()
+        pending.attempts += 1
+        self.last_sent = pending.sent_at
+        try:
+            await self.client.write_gatt_char(self.rx, f"#{seq}:{pending.command}".encode(), response=False)
+            self.stats["sent"] += 1
+        except Exception:
+            self.stats["errors"] += 1
+            raise
+
+    async def check_timeouts(self):
+        """Treat commands not acknowledged within the retransmission timeout as lost."""
+        now = time.monotonic()
+        timeout = self.retransmit_timeout()
+        for seq, pending in list(self.pending.items()):
+            if now - pending.sent_at < timeout:
+                continue
+            self.stats["lost"] += 1
+            # Back off on loss, at most once per timeout as a burst of loss hits every command
+            # in flight. Sending slower than every few timeouts can't relieve a busy link, so
+            # loss beyond that is taken as noise rather than backing off further.
+            if now - self.last_backoff >= timeout:
+                self.last_backoff = now
+                limit = min(MAX_SEND_INTERVAL, BACKOFF_TIMEOUTS * timeout)
+                self.send_interval = max(self.send_interval, min(limit, self.send_interval * 2))
+            # Past the duplicate window the motor base would apply a resend a second time
+            newer = (self.next_seq - seq) % SEQ_MODULUS
+            if pending.reliable and pending.attempts < MAX_ATTEMPTS and newer < DUPLICATE_WINDOW:
+                self.stats["resent"] += 1
+                await self.transmit(seq)
+            else:
+                if pending.reliable:
+                    print(f"{self.name}: giving up on {pending.command}")
+                if seq == self.pose_reset_seq:
+                    self.pose_reset = False
+                    self.pose_reset_seq = None
+                del self.pending[seq]
+
+    def handle_notify(self, _: BleakGATTCharacteristic, data: bytearray):
+        """Acknowledgements "A<seq>:<ticks_ms applied>" and pose changes from the motor base."""
+        message = data.decode(errors="replace")
+        if message.startswith("O"):
+            if self.pose_reset:
+                return
+            try:
+                dx, dy, dheading = (int(v) for v in message[1:].split(","))
+            except ValueError:
+                return
+            self.pose[0] += dx
+            self.pose[1] += dy
+            self.pose[2] += dheading / 1000
+        elif message.startswith("A"):
+            seq, _, applied = message[1:].partition(":")
+            pending = self.pending.pop(int(seq), None) if seq.isdigit() else None
+            if pending is None:
+                return
+            if int(seq) == self.pose_reset_seq:
+                self.pose = [0.0, 0.0, 0.0]
+                self.pose_reset = False
+                self.pose_reset_seq = None
+            self.stats["acked"] += 1
+            self.stats["last_applied_ms"] = int(applied) if applied.isdigit() else None
+            # Only time commands sent once, otherwise which send the ack is for is ambiguous
+            if pending.attempts == 1:
+                self.rtts.append(time.monotonic() - pending.sent_at)
+            # Speed up gently while commands are getting through
+            self.send_interval = max(MIN_SEND_INTERVAL, self.send_interval * SEND_INTERVAL_RECOVERY)
+            self.wakeup.set()
+
+    def retransmit_timeout(self) -> float:
+        if not self.rtts:
+            return INITIAL_TIMEOUT
+        return min(MAX_TIMEOUT, max(MIN_TIMEOUT, 2 * self.rtt_percentile(90)))
+
+    def rtt_percentile(self, percentile: float):
+        """Round trip time percentile in seconds over recent commands, None if nothing acknowledged yet."""
+        if not self.rtts:
+            return None
+        rtts = sorted(self.rtts)
+        return rtts[min(len(rtts) - 1, int(len(rtts) * percentile / 100))]
+
+    def link_stats(self):
+        """Stats plus round trip percentiles in ms and the current send interval."""
+        stats = dict(self.stats)
+        for percentile in (50, 90, 99):
+            rtt = self.rtt_percentile(percentile)
+            stats[f"rtt_p{percentile}_ms"] = None if rtt is None else round(rtt * 1000, 1)
+        stats["send_interval_ms"] = round(self.send_interval * 1000, 1)
+        return stats
 
     def handle_disconnect(self, _: BleakClient):
-        print("Device disconnected, goodbye.")
+        print(f"{self.name} disconnected.")
         self.is_connected = False
-        self.queue.append("x")
+        self.stats["disconnects"] += 1
+        self.wakeup.set()
 
     def send(self, speed: int, dir: str):
-        self.queue.append(f"{speed}{dir}")
+        self.queue.append("s" if dir == "s" else f"{speed}{dir}")
+        self.wakeup.set()
+
+    def upload_script(self, steps: list[tuple[int, int, str]]):
+        """
+            Replace the script on the motor base, split into packets that fit a BLE write.
+            Raises ValueError, before queuing anything, if a step or the script length is invalid.
+        """
+        if len(steps) > MAX_SCRIPT_STEPS:
+            raise ValueError(f"Script has {len(steps)} steps, at most {MAX_SCRIPT_STEPS} allowed")
+        for duration, speed, motion in steps:
+            if motion not in MOTIONS:
+                raise ValueError(f"Unknown motion {motion!r}")
+            if duration <= 0:
+                raise ValueError(f"Step duration must be positive, not {duration}")
+            if not 0 <= speed <= 100:
+                raise ValueError(f"Step speed must be 0 to 100, not {speed}")
+        self.control_queue.append("!c")
+        packet = "!a"
+        for duration, speed, motion in steps:
+            step = f"{duration}:{speed}{motion};"
+            if SEQ_HEADER_SIZE + len(packet) + len(step) > BLE_PACKET_SIZE:
+                self.control_queue.append(packet)
+                packet = "!a"
+            packet += step
+        if packet != "!a":
+            self.control_queue.append(packet)
+        self.wakeup.set()
+
+    def queue_control(self, command: str):
+        self.control_queue.append(command)
+        self.wakeup.set()
+
+    def reset_pose(self):
+        """Zero the odometry on the motor base, and here once it has acknowledged the reset."""
+        self.pose_reset = True
+        self.queue_control("!o")
+
+    def start_script(self):
+        self.queue_control("!g")
+
+    def pause_script(self):
+        self.queue_control("!p")
+
+    def resume_script(self):
+        self.queue_control("!r")
+
+    def abort_script(self):
+        self.queue_control("!x")
 
     def shutdown(self):
-        self.queue.append("s")
-        self.queue.append("x")
+        self.stopping = True
+        # Via the control queue so the stop is sent before the quit
+        self.queue_control("s")
+        self.queue_control("x")
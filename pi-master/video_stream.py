@@ -0,0 +1,118 @@
+# Shared H.264 encoder for streaming video to multiple clients
+import queue
+import threading
+from fractions import Fraction
+from typing import Iterator
+
+H264_BITRATE = 400_000  # bits per second
+H264_GOP = 30  # frames between keyframes
+H264_FPS = 30
+CLIENT_BUFFER = 60  # packets buffered per client before it is resynced at the next keyframe
+
+class VideoClient:
+    """Per-client packet queue, starts (and restarts after overflow) on a keyframe."""
+    def __init__(self):
+        self.packets = queue.Queue(CLIENT_BUFFER)
+        self.synced = False
+
+class H264Streamer:
+    """
+        Software H.264 encoder (libx264 via PyAV) fed from the capture thread.
+        One encoder is shared by all clients, each receiving raw Annex-B chunks.
+        Frames are only encoded while at least one client is connected, and a new
+        client forces a keyframe so it can start decoding straight away.
+    """
+    def __init__(self, bitrate: int = H264_BITRATE, gop: int = H264_GOP, fps: int = H264_FPS):
+        import av
+        self._av = av
+        self.bitrate = bitrate
+        self.gop = gop
+        self.fps = fps
+        self.codec = None
+        self.clients = []
+        self.lock = threading.Lock()
+        self.force_keyframe = False
+
+    @property
+    def active(self):
+        return len(self.clients) > 0
+
+    def _open(self, width, height):
+        codec = self._av.CodecContext.create('libx264', 'w')
+        codec.width = width
+        codec.height = height
+        codec.pix_fmt = 'yuv420p'
+        codec.bit_rate = self.bitrate
+        codec.framerate = Fraction(self.fps)
+        codec.time_base = Fraction(1, self.fps)
+        codec.gop_size = self.gop
+        # No B-frames or lookahead, each frame is sent as soon as it is encoded.
+        # SPS/PPS are repeated in-band before every keyframe, so clients can join at any keyframe.
+        codec.options = {'preset': 'ultrafast', 'tune': 'zerolatency'}
+        codec.open()
+        self.codec = codec
+        self.pts = 0
+
+    def encode(self, frame, yuv420: bool):
+        """
+            Encode one frame from the capture thread and hand the packets to the clients.
+            frame is a YUV420 array if yuv420 is set, otherwise BGR.
+        """
+        if not self.active:
+            if self.codec is not None:
+                # Last client gone, start afresh (with new headers) for the next one
+                self.codec = None
+            return
+        if yuv420:
+            height, width = frame.shape[0] * 2 // 3, frame.shape[1]
+            video_frame = self._av.VideoFrame.from_ndarray(frame, format='yuv420p')
+        else:
+            height, width = frame.shape[:2]
+            video_frame = self._av.VideoFrame.from_ndarray(frame, format='bgr24')
+        if self.codec is None:
+            self._open(width, height)
+        video_frame.pts = self.pts
+        self.pts += 1
+        if self.force_keyframe:
+            self.force_keyframe = False
+            video_frame.pict_type = self._av.video.frame.PictureType.I
+        for packet in self.codec.encode(video_frame):
+            self._publish(bytes(packet), packet.is_keyframe)
+
+    def _publish(self, data: bytes, keyframe: bool):
+        with self.lock:
+            for client in self.clients:
+                if keyframe:
+                    client.synced = True
+                if not client.synced:
+                    continue
+                try:
+                    client.packets.put_nowait(data)
+                except queue.Full:
+                    # Client too slow, drop everything until the next keyframe
+                    client.synced = False
+                    self.force_keyframe = True
+
+    def subscribe(self) -> VideoClient:
+        client = VideoClient()
+        with self.lock:
+            self.clients.append(client)
+            self.force_keyframe = True
+        return client
+
+    def unsubscribe(self, client: VideoClient):
+        with self.lock:
+            self.clients.remove(client)
+
+    def packets(self) -> Iterator[bytes]:
+        """Annex-B byte stream for one client, for use as a streaming response body."""
+        client = self.subscribe()
+        try:
+            while True:
+                try:
+                    yield client.packets.get(timeout=5)
+                except queue.Empty:
+                    # Capture stopped, end the stream
+                    return
+        finally:
+            self.unsubscribe(client)